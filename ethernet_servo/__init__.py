@@ -3,5 +3,8 @@ __all__ = ['api', 'control', 'ethernet_encoder_servo']
 
 
 def main():
+    import time
+    startup_begin = time.monotonic()
+
     from .ethernet_encoder_servo import main
-    main()
+    main(startup_begin=startup_begin)
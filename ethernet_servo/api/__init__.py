@@ -1,7 +1,7 @@
 import logging
 
 from flask import current_app as app
-from flask import Blueprint
+from flask import Blueprint, request
 
 from flask_restplus import Api, Resource
 from flask_cors import CORS
@@ -31,6 +31,14 @@ def register(application):
     })
 
 
+@blueprint.after_request
+def notify_changes(response):
+    """ Commands change device state right away, let state watchers know without waiting for the next poll """
+    if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+        control.devices.changed()
+    return response
+
+
 @api.errorhandler
 def default_error_handler(e):
     message = 'An unhandled exception occurred.'
@@ -49,5 +57,5 @@ class BaseResource(Resource):
             api.abort(404, "Device '{}' does not exist".format(name))
 
 
-from . import devices, goto, sync
-__all__ = ['models', 'devices', 'goto', 'sync']
+from . import devices, goto, sync, autotune, correction, batch, sequences, state, stream, ephemeris, profiling, tracing
+__all__ = ['models', 'devices', 'goto', 'sync', 'autotune', 'correction', 'batch', 'sequences', 'state', 'stream', 'ephemeris', 'profiling', 'tracing']
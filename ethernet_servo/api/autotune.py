@@ -0,0 +1,55 @@
+from ethernet_servo.control.autotune import DEFAULT_RULE
+from ethernet_servo.api import api, BaseResource
+
+from . import models
+
+
+ns = api.namespace('devices', description='Configured servo controllers')
+
+
+@ns.route('/<string:name>/autotune')
+@ns.param('name', 'The servo controller name as configured')
+class DeviceAutotune(BaseResource):
+    @ns.doc('Status and proposed gains of the last autotune run')
+    @ns.marshal_with(models.AutotuneStatus)
+    def get(self, name):
+        device = self.get_device(name)
+        return device.controller.autotune_status
+
+    @ns.doc('Starts a relay feedback experiment around the current position')
+    @ns.marshal_with(models.AutotuneStatus)
+    @ns.expect(models.Autotune)
+    def put(self, name):
+        device = self.get_device(name)
+
+        payload = api.payload
+        try:
+            device.controller.start_autotune(
+                amplitude=payload['amplitude'],
+                max_excursion=payload['max_excursion'],
+                cycles=payload.get('cycles', 4),
+                rule=payload.get('rule', DEFAULT_RULE),
+                apply=payload.get('apply', False),
+            )
+        except (KeyError, ValueError) as e:
+            api.abort(400, 'Invalid autotune parameters: {}'.format(e))
+
+        return device.controller.autotune_status
+
+    @ns.doc('Aborts a running autotune experiment')
+    @ns.marshal_with(models.AutotuneStatus)
+    def delete(self, name):
+        device = self.get_device(name)
+        device.controller.stop_autotune()
+        return device.controller.autotune_status
+
+
+@ns.route('/<string:name>/autotune/apply')
+@ns.param('name', 'The servo controller name as configured')
+class DeviceAutotuneApply(BaseResource):
+    @ns.doc('Uses the gains proposed by the last autotune run')
+    @ns.marshal_with(models.ControllerState)
+    def put(self, name):
+        device = self.get_device(name)
+        device.controller.apply_autotune()
+        return device.controller.state
@@ -0,0 +1,26 @@
+import ethernet_servo.control as control
+from ethernet_servo.control import commands
+from ethernet_servo.api import api, BaseResource
+
+from . import models
+
+
+ns = api.namespace('batch', description='Commands for several devices applied at once')
+
+
+@ns.route('/')
+class Batch(BaseResource):
+    @ns.doc('Applies every command at once, or none of them if any is invalid. Returns the status of all devices')
+    @ns.expect([models.Command])
+    @ns.marshal_list_with(models.DeviceStatus)
+    def post(self):
+        payload = api.payload
+        if not isinstance(payload, list):
+            api.abort(400, 'Expected a list of commands')
+
+        try:
+            commands.apply_batch(payload)
+        except ValueError as e:
+            api.abort(400, str(e))
+
+        return control.devices.get()
@@ -0,0 +1,54 @@
+from ethernet_servo.control.correction import DEFAULT_LEARNING_GAIN
+from ethernet_servo.api import api, BaseResource
+
+from . import models
+
+
+ns = api.namespace('devices', description='Configured servo controllers')
+
+
+@ns.route('/<string:name>/correction')
+@ns.param('name', 'The servo controller name as configured')
+class DeviceCorrection(BaseResource):
+    @ns.doc('Periodic error and backlash correction table')
+    @ns.marshal_with(models.Correction)
+    def get(self, name):
+        device = self.get_device(name)
+        if device.controller.correction is None:
+            api.abort(404, "Device '{}' has no correction table".format(name))
+        return device.controller.correction.to_dict()
+
+    @ns.doc('Sets a new table when period, values or bins are given, otherwise changes backlash, enabled and recording')
+    @ns.marshal_with(models.Correction)
+    @ns.expect(models.Correction)
+    def put(self, name):
+        device = self.get_device(name)
+        if not isinstance(api.payload, dict):
+            api.abort(400, 'Expected a correction table object')
+        try:
+            device.controller.set_correction(api.payload)
+        except (TypeError, ValueError) as e:
+            api.abort(400, 'Invalid correction table: {}'.format(e))
+        return device.controller.correction.to_dict()
+
+    @ns.doc('Removes the correction table')
+    def delete(self, name):
+        device = self.get_device(name)
+        device.controller.clear_correction()
+        return '', 204
+
+
+@ns.route('/<string:name>/correction/learn')
+@ns.param('name', 'The servo controller name as configured')
+class DeviceCorrectionLearn(BaseResource):
+    @ns.doc('Folds the periodic part of the recorded tracking errors into the table and starts a new recording')
+    @ns.marshal_with(models.Correction)
+    @ns.expect(models.CorrectionLearn)
+    def put(self, name):
+        device = self.get_device(name)
+        gain = (api.payload or {}).get('gain', DEFAULT_LEARNING_GAIN)
+        try:
+            device.controller.learn_correction(gain)
+        except (TypeError, ValueError) as e:
+            api.abort(400, str(e))
+        return device.controller.correction.to_dict()
@@ -46,10 +46,7 @@ class DeviceFreeRun(BaseResource):
     def put(self, name):
         device = self.get_device(name)
 
-        speed = control.units.AnglePosition()
-        speed.degrees = api.payload['degrees']
-        speed.minutes = api.payload['minutes']
-        speed.seconds = api.payload['seconds']
+        speed = control.units.AnglePosition(api.payload['degrees'], api.payload['minutes'], api.payload['seconds'])
         device.controller.run_speed = speed
         return device
 
@@ -78,6 +75,7 @@ class DeviceHalt(BaseResource):
 
         device.controller.closed_loop = False
         device.controller.tracking = False
+        control.sequencer.abort(device, 'halted')
         return device
 
 
@@ -109,6 +107,9 @@ class DeviceControllerState(BaseResource):
     def put(self, name):
         device = self.get_device(name)
 
-        device.controller.set_control_parameters(api.payload)
+        try:
+            device.controller.set_control_parameters(api.payload)
+        except (TypeError, ValueError) as e:
+            api.abort(400, str(e))
 
         return device.controller.state
@@ -0,0 +1,47 @@
+from ethernet_servo.control import ephemeris
+from ethernet_servo.api import api, BaseResource
+
+from . import models
+
+
+ns = api.namespace('ephemeris', description='Ephemerides of moving targets')
+
+
+@ns.route('/')
+class EphemerisList(BaseResource):
+    @ns.doc('Loaded ephemerides')
+    @ns.marshal_list_with(models.Ephemeris)
+    def get(self):
+        return [table.to_dict() for table in ephemeris.get()]
+
+
+@ns.route('/<string:name>')
+@ns.param('name', 'The ephemeris name')
+class Ephemeris(BaseResource):
+    def get_ephemeris(self, name):
+        table = ephemeris.get(name)
+        if table is None:
+            api.abort(404, "Ephemeris '{}' does not exist".format(name))
+        return table
+
+    @ns.doc('Time span of an ephemeris')
+    @ns.marshal_with(models.Ephemeris)
+    def get(self, name):
+        return self.get_ephemeris(name).to_dict()
+
+    @ns.doc('Loads or replaces an ephemeris')
+    @ns.marshal_with(models.Ephemeris)
+    @ns.expect(models.EphemerisTable)
+    def put(self, name):
+        try:
+            table = ephemeris.Ephemeris.from_rows(name, api.payload['rows'])
+        except (KeyError, ValueError) as e:
+            api.abort(400, str(e))
+
+        return ephemeris.add(table).to_dict()
+
+    @ns.doc('Removes an ephemeris, axes following it keep their current cache')
+    def delete(self, name):
+        self.get_ephemeris(name)
+        ephemeris.remove(name)
+        return '', 204
@@ -1,4 +1,4 @@
-from ethernet_servo.control import units
+from ethernet_servo.control import units, ephemeris
 from ethernet_servo.api import api, BaseResource
 
 from . import models
@@ -28,10 +28,7 @@ class DeviceGotoAstronomical(BaseResource):
     def put(self, name):
         device = self.get_device(name)
 
-        target = units.AstronomicalPosition()
-        target.hours = api.payload['hours']
-        target.minutes = api.payload['minutes']
-        target.seconds = api.payload['seconds']
+        target = units.AstronomicalPosition(api.payload['hours'], api.payload['minutes'], api.payload['seconds'])
         device.controller.target_astronomical = target
         return device
 
@@ -45,10 +42,7 @@ class DeviceGotoAngle(BaseResource):
     def put(self, name):
         device = self.get_device(name)
 
-        target = units.AnglePosition()
-        target.degrees = api.payload['degrees']
-        target.minutes = api.payload['minutes']
-        target.seconds = api.payload['seconds']
+        target = units.AnglePosition(api.payload['degrees'], api.payload['minutes'], api.payload['seconds'])
         device.controller.target_angle = target.to_decimal()
         return device
 
@@ -63,11 +57,9 @@ class DeviceGotoRelativeAngle(BaseResource):
         device = self.get_device(name)
 
         current_target = device.controller.target_angle
-        current_target.degrees += api.payload['degrees']
-        current_target.minutes += api.payload['minutes']
-        current_target.seconds += api.payload['seconds']
+        offset = units.AnglePosition(api.payload['degrees'], api.payload['minutes'], api.payload['seconds'])
 
-        device.controller.target_angle = current_target
+        device.controller.target_angle = current_target + offset
 
         return device
 
@@ -82,11 +74,30 @@ class DeviceGotoRelativeAstronomical(BaseResource):
         device = self.get_device(name)
 
         current_target = device.controller.target_astronomical
+        offset = units.AstronomicalPosition(api.payload['hours'], api.payload['minutes'], api.payload['seconds'])
 
-        current_target.hours += api.payload['hours']
-        current_target.minutes += api.payload['minutes']
-        current_target.seconds += api.payload['seconds']
+        device.controller.target_astronomical = current_target + offset
 
-        device.controller.target_astronomical = current_target
+        return device
+
+
+@ns.route('/<string:name>/goto/ephemeris')
+@ns.param('name', 'The servo controller name as configured')
+class DeviceGotoEphemeris(BaseResource):
+    @ns.doc('Tracks a moving target from a loaded ephemeris')
+    @ns.marshal_with(models.DeviceStatus)
+    @ns.expect(models.EphemerisGoto)
+    def put(self, name):
+        device = self.get_device(name)
+
+        table = ephemeris.get(api.payload['ephemeris'])
+        if table is None:
+            api.abort(404, "Ephemeris '{}' does not exist".format(api.payload['ephemeris']))
 
+        try:
+            target = ephemeris.EphemerisTarget(table, api.payload.get('coordinate', 'ra'))
+        except ValueError as e:
+            api.abort(400, str(e))
+
+        device.controller.target_astronomical = target
         return device
@@ -1,6 +1,8 @@
 from flask_restplus import fields
 
+from ethernet_servo import tracing
 from ethernet_servo.api import api
+from ethernet_servo.control import autotune, commands, correction, ephemeris, polling, scheduling, sequencer
 
 
 Device = api.model('Device', {
@@ -12,8 +14,12 @@ Device = api.model('Device', {
     'offset': fields.Integer(attribute='controller.state.offset'),
     'max_speed': fields.Integer,
     'interval': fields.Integer,
+    'min_interval': fields.Integer(attribute='controller.polling.intervals.fast'),
+    'max_interval': fields.Integer(attribute='controller.polling.intervals.idle'),
     'invert': fields.Boolean,
     'serial_port': fields.String,
+    'serial_baudrate': fields.Integer(attribute='serial_interface.baudrate'),
+    'serial_connected': fields.Boolean(attribute='serial_interface.connected'),
     'supports_hour_angle': fields.Boolean,
     'can_track': fields.Boolean,
     'closed_loop': fields.Boolean(attribute='controller.state.closed_loop'),
@@ -45,16 +51,38 @@ AstronomicalPosition = api.model('AstronomicalPosition', {
 })
 
 
+Polling = api.model('Polling', {
+    'mode': fields.String(enum=polling.MODES),
+    'interval': fields.Integer(description='Current polling interval in milliseconds'),
+})
+
+
+Gains = api.model('Gains', {
+    'Kp': fields.Float,
+    'Ki': fields.Float,
+    'Kd': fields.Float,
+    'derivative_filtering': fields.Float,
+    'deadband': fields.Float(description='Errors smaller than this many encoder counts are ignored'),
+})
+
+
 ControllerState = api.model('ControllerState', {
     'offset': fields.Integer(attribute='offset', default=0),
     'error': fields.Float(attribute='error', default=0),
     'position': fields.Float(attribute='position', default=0),
     'output': fields.Float(attribute='output', default=0),
     'max_slew_rate': fields.Float(attribute='pid.max_slew_rate', default=12000),
+    'max_slew_speed': fields.Float(attribute='pid.max_slew_speed'),
+    'max_acceleration': fields.Float(attribute='pid.max_acceleration'),
     'derivative_filtering': fields.Float(attribute='pid.derivative_filtering', default=0.75),
     'Kp': fields.Float(attribute='pid.Kp', default=1.8),
     'Ki': fields.Float(attribute='pid.Ki', default=1),
     'Kd': fields.Float(attribute='pid.Kd', default=1),
+    'feedforward': fields.Float(attribute='pid.feedforward', default=1),
+    'gain_schedule': fields.Raw(attribute='pid.gain_schedule', description='Gains that differ from the ones above for '
+                                'each regime: {}'.format(', '.join(scheduling.REGIMES))),
+    'regime': fields.String(attribute='regime', enum=scheduling.REGIMES),
+    'active_gains': fields.Nested(model=Gains, attribute='pid.active_gains'),
     # 'invert': fields.Boolean(attribute='device.invert'),
     'tracking': fields.Boolean(attribute='tracking', default=False),
     'free_running': fields.Boolean(attribute='free_running', default=False),
@@ -70,12 +98,201 @@ DeviceStatus = api.model('DeviceStatus', {
     'free_running': fields.Boolean(attribute='controller.state.free_running'),
     'run_speed': fields.Nested(model=AnglePosition, attribute='controller.state.run_speed'),
     'closed_loop': fields.Boolean(attribute='controller.state.closed_loop'),
+    'slewing': fields.Boolean(attribute='controller.state.slewing'),
     'target': fields.Float(attribute='controller.state.target'),
+    'setpoint': fields.Float(attribute='controller.state.setpoint'),
     'target_angle': fields.Nested(model=AnglePosition, attribute='controller.state.target_angle'),
     'target_astronomical': fields.Nested(model=AstronomicalPosition, attribute='controller.state.target_astronomical'),
     'position': fields.Float(attribute='controller.state.position'),
     'position_angle': fields.Nested(model=AnglePosition, attribute='controller.state.position_angle'),
     'position_astronomical': fields.Nested(model=AstronomicalPosition, attribute='controller.state.position_astronomical'),
     'error': fields.Float(attribute='controller.state.error'),
+    'polling': fields.Nested(model=Polling, attribute='controller.state.polling'),
+    'encoder_jumps': fields.Integer(attribute='controller.state.encoder_jumps', description='Encoder readings ignored as impossible'),
     'pid': fields.Nested(model=ControllerState, attribute='controller.state')
 })
+
+
+StateSnapshot = api.model('StateSnapshot', {
+    'version': fields.Integer(description='Increases every time any device changes'),
+    'devices': fields.List(fields.Nested(DeviceStatus)),
+})
+
+
+Autotune = api.model('Autotune', {
+    'amplitude': fields.Float(required=True, description='Relay speed in degrees per second'),
+    'max_excursion': fields.Float(required=True, description='Maximum distance from the current position in degrees'),
+    'cycles': fields.Integer(default=4, description='Oscillation cycles to measure'),
+    'rule': fields.String(default=autotune.DEFAULT_RULE, enum=sorted(autotune.RULES)),
+    'apply': fields.Boolean(default=False, description='Use the proposed gains when done'),
+})
+
+
+AutotuneStatus = api.model('AutotuneStatus', {
+    'state': fields.String(enum=['idle', 'running', 'done', 'failed']),
+    'message': fields.String,
+    'rule': fields.String,
+    'apply': fields.Boolean,
+    'elapsed': fields.Float,
+    'switches': fields.Integer,
+    'Ku': fields.Float,
+    'Tu': fields.Float,
+    'oscillation': fields.Float,
+    'Kp': fields.Float,
+    'Ki': fields.Float,
+    'Kd': fields.Float,
+    'derivative_filtering': fields.Float,
+})
+
+
+Correction = api.model('Correction', {
+    'period': fields.Float(description='Encoder counts of unwrapped position the table repeats every'),
+    'values': fields.List(fields.Float, description='Setpoint corrections in encoder counts at evenly spaced phases'),
+    'bins': fields.Integer(description='Number of values of a new, empty, table. Write only'),
+    'backlash': fields.Float(description='Encoder counts taken up when the motion reverses'),
+    'enabled': fields.Boolean,
+    'recording': fields.Boolean(description='Records the tracking errors to learn from'),
+    'coverage': fields.Float(readonly=True, description='Fraction of the table with enough recorded samples'),
+})
+
+
+CorrectionLearn = api.model('CorrectionLearn', {
+    'gain': fields.Float(default=correction.DEFAULT_LEARNING_GAIN,
+                         description='Fraction of the recorded error added to the table'),
+})
+
+
+Command = api.model('Command', {
+    'device': fields.String(required=True, description='Device id'),
+    'command': fields.String(required=True, enum=commands.COMMANDS),
+    'units': fields.String(default='raw', enum=commands.UNITS, description='Position units for goto and sync'),
+    'value': fields.Float(description='Raw position'),
+    'degrees': fields.Integer,
+    'hours': fields.Integer,
+    'minutes': fields.Integer,
+    'seconds': fields.Float,
+    'tracking': fields.Boolean,
+    'ephemeris': fields.String(description='Ephemeris name for goto in ephemeris units'),
+    'coordinate': fields.String(enum=ephemeris.COORDINATES),
+})
+
+
+TelemetryClient = api.model('TelemetryClient', {
+    'name': fields.String(description='Transport and address or session id'),
+    'devices': fields.List(fields.String, description='Devices streamed, all if empty'),
+    'delivered': fields.Integer(description='Frames sent'),
+    'dropped': fields.Integer(description='Frames skipped because the client was behind'),
+    'rate': fields.Float(description='Current maximum frames per second for each device, 0 if unlimited'),
+})
+
+
+EphemerisRow = api.model('EphemerisRow', {
+    'time': fields.String(required=True, description='Unix timestamp or ISO 8601 date, UTC unless given'),
+    'ra': fields.Float(required=True, description='Right ascension in hours'),
+    'dec': fields.Float(required=True, description='Declination in degrees'),
+})
+
+
+EphemerisTable = api.model('EphemerisTable', {
+    'rows': fields.List(fields.Nested(EphemerisRow), required=True),
+})
+
+
+Ephemeris = api.model('Ephemeris', {
+    'name': fields.String,
+    'start': fields.Float(description='Unix timestamp of the first row'),
+    'end': fields.Float(description='Unix timestamp of the last row'),
+    'rows': fields.Integer,
+})
+
+
+EphemerisGoto = api.model('EphemerisGoto', {
+    'ephemeris': fields.String(required=True, description='Name of a loaded ephemeris'),
+    'coordinate': fields.String(default='ra', enum=ephemeris.COORDINATES, description='Coordinate followed by this axis'),
+})
+
+
+ProfilingStage = api.model('ProfilingStage', {
+    'name': fields.String,
+    'count': fields.Integer,
+    'total': fields.Float(description='Seconds'),
+    'mean': fields.Float(description='Seconds'),
+    'min': fields.Float(description='Seconds'),
+    'max': fields.Float(description='Seconds'),
+})
+
+
+ProfilingToggle = api.model('ProfilingToggle', {
+    'enabled': fields.Boolean(required=True),
+})
+
+
+Profiling = api.model('Profiling', {
+    'enabled': fields.Boolean,
+    'elapsed': fields.Float(description='Seconds since the aggregates were reset'),
+    'stages': fields.List(fields.Nested(ProfilingStage)),
+})
+
+
+LatencySegment = api.model('LatencySegment', {
+    'samples': fields.Integer,
+    'p50': fields.Float(description='Seconds'),
+    'p90': fields.Float(description='Seconds'),
+    'p99': fields.Float(description='Seconds'),
+    'mean': fields.Float(description='Seconds'),
+    'max': fields.Float(description='Seconds'),
+})
+
+
+Latency = api.model('Latency', {
+    'device': fields.String,
+    'traces': fields.Integer(description='Samples traced since startup'),
+    'cycles': fields.Integer(description='Samples that went through a control cycle since startup'),
+    'segments': fields.Raw(description='LatencySegment for each of ' + ', '.join(name for name, _, _ in tracing.SEGMENTS)),
+})
+
+
+SettleCondition = api.model('SettleCondition', {
+    'tolerance': fields.Float(default=sequencer.DEFAULT_SETTLE_TOLERANCE,
+                              description='Distance to the target in arcseconds'),
+    'stable': fields.Float(default=sequencer.DEFAULT_SETTLE_STABLE,
+                           description='Seconds every device has to stay within tolerance'),
+    'timeout': fields.Float(default=sequencer.DEFAULT_SETTLE_TIMEOUT, description='Seconds to wait for it'),
+})
+
+
+SequenceStep = api.model('SequenceStep', {
+    'commands': fields.List(fields.Nested(Command), description='Applied at once, like a batch'),
+    'settle': fields.Nested(SettleCondition, allow_null=True, description='null or false to only dwell'),
+    'dwell': fields.Float(default=0, description='Seconds to stay once settled'),
+    'on_timeout': fields.String(default='fail', enum=['fail', 'continue']),
+})
+
+
+NewSequence = api.model('NewSequence', {
+    'name': fields.String,
+    'steps': fields.List(fields.Nested(SequenceStep), required=True),
+})
+
+
+Sequence = api.model('Sequence', {
+    'id': fields.String,
+    'name': fields.String,
+    'state': fields.String(enum=sequencer.STATES),
+    'step': fields.Integer(description='Current step, 0 based'),
+    'steps': fields.List(fields.Nested(SequenceStep)),
+    'devices': fields.List(fields.String),
+    'message': fields.String,
+    'elapsed': fields.Float(description='Seconds since it started'),
+})
+
+
+SequenceEvent = api.model('SequenceEvent', {
+    'sequence': fields.String,
+    'name': fields.String,
+    'state': fields.String(enum=sequencer.STATES),
+    'step': fields.Integer,
+    'steps': fields.Integer,
+    'message': fields.String,
+    'elapsed': fields.Float,
+})
@@ -0,0 +1,52 @@
+from flask import Response
+from flask_restplus import reqparse
+
+from ethernet_servo import profiling
+from ethernet_servo.api import api, BaseResource
+
+from . import models
+
+
+ns = api.namespace('profiling', description='Timing of each stage of the control cycle')
+
+capture_parser = reqparse.RequestParser()
+capture_parser.add_argument('seconds', type=float, default=profiling.DEFAULT_CAPTURE_SECONDS, location='args',
+                            help='Capture length, {:.0f} seconds at most'.format(profiling.MAX_CAPTURE_SECONDS))
+capture_parser.add_argument('interval', type=float, default=profiling.DEFAULT_CAPTURE_INTERVAL, location='args',
+                            help='Seconds between samples')
+
+
+@ns.route('/')
+class Profiling(BaseResource):
+    @ns.doc('Timing aggregates of every stage since profiling was enabled')
+    @ns.marshal_with(models.Profiling)
+    def get(self):
+        return profiling.stats()
+
+    @ns.doc('Turns stage timing on or off')
+    @ns.marshal_with(models.Profiling)
+    @ns.expect(models.ProfilingToggle)
+    def put(self):
+        profiling.enable(bool(api.payload.get('enabled')))
+        return profiling.stats()
+
+    @ns.doc('Clears the timing aggregates')
+    @ns.marshal_with(models.Profiling)
+    def delete(self):
+        profiling.reset()
+        return profiling.stats()
+
+
+@ns.route('/capture')
+class ProfilingCapture(BaseResource):
+    @ns.doc('Samples every thread for a while and returns the collapsed stacks (flamegraph.pl, speedscope)')
+    @ns.expect(capture_parser)
+    def get(self):
+        args = capture_parser.parse_args()
+        if args['seconds'] <= 0 or args['interval'] <= 0:
+            api.abort(400, 'seconds and interval must be positive')
+
+        stacks = profiling.capture(args['seconds'], args['interval'])
+        return Response(stacks, mimetype='text/plain', headers={
+            'Content-Disposition': 'attachment; filename=profile.folded',
+        })
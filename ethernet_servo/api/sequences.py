@@ -0,0 +1,92 @@
+import json
+
+from flask import Response, request, stream_with_context
+from flask_restplus import reqparse
+
+from ethernet_servo import telemetry
+from ethernet_servo.control import sequencer
+from ethernet_servo.api import api, BaseResource
+
+from . import models
+from .stream import keepalive
+
+
+ns = api.namespace('sequences', description='Moves run one after the other by the server')
+
+parser = reqparse.RequestParser()
+parser.add_argument('format', type=str, choices=('sse', 'ndjson'), location='args',
+                    help='Server-Sent Events or newline delimited JSON, defaults to SSE if accepted by the client')
+
+
+def get_sequence(sequence_id):
+    sequence = sequencer.get(sequence_id)
+    if sequence is None:
+        api.abort(404, "Sequence '{}' does not exist".format(sequence_id))
+    return sequence
+
+
+@ns.route('/')
+class SequenceList(BaseResource):
+    @ns.doc('Running and recently finished sequences')
+    @ns.marshal_list_with(models.Sequence)
+    def get(self):
+        return [sequence.to_dict() for sequence in sequencer.get()]
+
+    @ns.doc('Starts a sequence: each step applies its commands at once, waits for its devices to settle and dwells')
+    @ns.expect(models.NewSequence)
+    @ns.marshal_with(models.Sequence, code=201)
+    def post(self):
+        payload = api.payload or {}
+        try:
+            sequence = sequencer.start(payload.get('steps'), payload.get('name'))
+        except ValueError as e:
+            api.abort(400, str(e))
+        return sequence.to_dict(), 201
+
+
+@ns.route('/<string:sequence_id>')
+class Sequence(BaseResource):
+    @ns.doc('Progress of a sequence')
+    @ns.marshal_with(models.Sequence)
+    def get(self, sequence_id):
+        return get_sequence(sequence_id).to_dict()
+
+    @ns.doc('Aborts a sequence, devices stay where they are')
+    @ns.marshal_with(models.Sequence)
+    def delete(self, sequence_id):
+        sequence = get_sequence(sequence_id)
+        sequence.abort()
+        return sequence.to_dict()
+
+
+@ns.route('/<string:sequence_id>/events')
+class SequenceEvents(BaseResource):
+    @ns.doc('Streams the progress events of a sequence until it finishes')
+    @ns.expect(parser)
+    @ns.response(200, 'Success', models.SequenceEvent)
+    def get(self, sequence_id):
+        sequence = get_sequence(sequence_id)
+        args = parser.parse_args()
+
+        stream_format = args['format']
+        if stream_format is None:
+            stream_format = 'sse' if 'text/event-stream' in request.headers.get('Accept', '') else 'ndjson'
+
+        def generate():
+            seen = 0
+            while True:
+                events = sequence.wait_for_event(seen, timeout=telemetry.KEEPALIVE)
+                if not events:
+                    yield keepalive(stream_format)
+                for event in events:
+                    data = json.dumps(event)
+                    yield 'event: sequence\ndata: {}\n\n'.format(data) if stream_format == 'sse' else data + '\n'
+                seen += len(events)
+                if sequence.finished and seen >= len(sequence.events):
+                    return
+
+        mimetype = 'text/event-stream' if stream_format == 'sse' else 'application/x-ndjson'
+        return Response(stream_with_context(generate()), mimetype=mimetype, headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        })
@@ -0,0 +1,68 @@
+import os
+import time
+
+from flask import request
+from flask_restplus import marshal, reqparse
+
+import ethernet_servo.control as control
+from ethernet_servo.api import api, BaseResource
+
+from . import models
+
+
+ns = api.namespace('state', description='Consistent snapshot of every device')
+
+# Longest long poll allowed, in seconds
+MAX_WAIT = 30
+
+# Versions start again on every run, keep etags from an old process from matching
+RUN_ID = '{0:x}{1:x}'.format(int(time.time()), os.getpid())
+
+parser = reqparse.RequestParser()
+parser.add_argument('wait', type=float, default=0, location='args',
+                    help='Seconds to wait for a change when If-None-Match matches the current version')
+
+
+def etag(version):
+    return '"{0}-{1}"'.format(RUN_ID, version)
+
+
+def requested_etags():
+    header = request.headers.get('If-None-Match', '')
+    return [tag.strip().replace('W/', '', 1) for tag in header.split(',') if tag.strip()]
+
+
+def snapshot(version):
+    """ Computes each device state once so every field comes from the same control cycle """
+    return {
+        'version': version,
+        'devices': [{
+            'name': device.name,
+            'controller': {'state': device.controller.state},
+        } for device in control.devices.get()],
+    }
+
+
+@ns.route('/')
+class State(BaseResource):
+    @ns.doc('Status of every device. Supports If-None-Match, and waiting for a change with the wait parameter')
+    @ns.expect(parser)
+    @ns.response(200, 'Success', models.StateSnapshot)
+    @ns.response(304, 'Not modified since the version in If-None-Match')
+    def get(self):
+        args = parser.parse_args()
+        version = control.devices.version()
+
+        known = requested_etags()
+        if etag(version) in known and args['wait'] > 0:
+            version = control.devices.wait_for_change(version, min(args['wait'], MAX_WAIT))
+
+        headers = {
+            'ETag': etag(version),
+            'Cache-Control': 'no-cache',
+        }
+
+        if etag(version) in known:
+            return '', 304, headers
+
+        return marshal(snapshot(version), models.StateSnapshot), 200, headers
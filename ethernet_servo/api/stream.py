@@ -0,0 +1,98 @@
+import time
+
+from flask import Response, request, stream_with_context
+from flask_restplus import reqparse
+
+from ethernet_servo import telemetry
+from ethernet_servo.api import api, BaseResource
+
+from . import models
+
+
+ns = api.namespace('stream', description='Streaming telemetry over plain HTTP')
+
+parser = reqparse.RequestParser()
+parser.add_argument('rate', type=float, default=0, location='args',
+                    help='Maximum samples per second for each device, 0 sends every sample')
+parser.add_argument('fields', type=str, default='', location='args',
+                    help='Comma separated fields to send, all of them if empty')
+parser.add_argument('format', type=str, choices=('sse', 'ndjson'), location='args',
+                    help='Server-Sent Events or newline delimited JSON, defaults to SSE if accepted by the client')
+
+
+def encode(frame, fields, stream_format):
+    data = frame.to_json(fields)
+    if stream_format == 'sse':
+        return 'event: position\ndata: {}\n\n'.format(data)
+    return data + '\n'
+
+
+def keepalive(stream_format):
+    if stream_format == 'sse':
+        return ': keepalive\n\n'
+    return '\n'
+
+
+def stream(device_ids=None):
+    args = parser.parse_args()
+
+    stream_format = args['format']
+    if stream_format is None:
+        stream_format = 'sse' if 'text/event-stream' in request.headers.get('Accept', '') else 'ndjson'
+
+    fields = [field.strip() for field in args['fields'].split(',') if field.strip()]
+    period = 1.0 / args['rate'] if args['rate'] > 0 else 0
+
+    subscription = telemetry.hub.subscribe(device_ids, name='{0} {1}'.format(stream_format, request.remote_addr))
+    subscription.period = period
+
+    def generate():
+        try:
+            while True:
+                frames = subscription.get(timeout=telemetry.KEEPALIVE)
+                if not frames:
+                    yield keepalive(stream_format)
+                    continue
+
+                for frame in frames.values():
+                    yield encode(frame, fields, stream_format)
+                    # Resumed once the server wrote the chunk
+                    frame.sent()
+
+                # Samples arriving meanwhile replace each other, so slow rates only get the latest one
+                if period:
+                    time.sleep(period)
+        finally:
+            subscription.close()
+
+    mimetype = 'text/event-stream' if stream_format == 'sse' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+@ns.route('/')
+class TelemetryStream(BaseResource):
+    @ns.doc('Streams the state of every device on each control cycle')
+    @ns.expect(parser)
+    def get(self):
+        return stream()
+
+
+@ns.route('/clients')
+class TelemetryClients(BaseResource):
+    @ns.doc('Clients receiving telemetry, with how many frames they got and how many were dropped for them')
+    @ns.marshal_list_with(models.TelemetryClient)
+    def get(self):
+        return [subscription.to_dict() for subscription in telemetry.hub.subscriptions]
+
+
+@ns.route('/<string:name>')
+@ns.param('name', 'The servo controller name as configured')
+class DeviceTelemetryStream(BaseResource):
+    @ns.doc('Streams the state of a single device on each control cycle')
+    @ns.expect(parser)
+    def get(self, name):
+        device = self.get_device(name)
+        return stream([device.id])
@@ -28,10 +28,7 @@ class DeviceSyncAstronomical(BaseResource):
     def put(self, name):
         device = self.get_device(name)
 
-        target = units.AstronomicalPosition()
-        target.hours = api.payload['hours']
-        target.minutes = api.payload['minutes']
-        target.seconds = api.payload['seconds']
+        target = units.AstronomicalPosition(api.payload['hours'], api.payload['minutes'], api.payload['seconds'])
         device.controller.sync_astronomical(target)
         return device
 
@@ -46,9 +43,6 @@ class DeviceSyncAngle(BaseResource):
     def put(self, name):
         device = self.get_device(name)
 
-        target = units.AnglePosition()
-        target.degrees = api.payload['degrees']
-        target.minutes = api.payload['minutes']
-        target.seconds = api.payload['seconds']
+        target = units.AnglePosition(api.payload['degrees'], api.payload['minutes'], api.payload['seconds'])
         device.controller.sync_angle(target.to_decimal())
         return device
@@ -0,0 +1,25 @@
+from ethernet_servo import tracing
+from ethernet_servo.api import api, BaseResource
+
+from . import models
+
+
+ns = api.namespace('tracing', description='Latency of encoder samples through the server')
+
+
+@ns.route('/')
+class LatencyList(BaseResource):
+    @ns.doc('Latency percentiles of every device')
+    @ns.marshal_list_with(models.Latency)
+    def get(self):
+        return [tracer.to_dict() for tracer in tracing.get()]
+
+
+@ns.route('/<string:name>')
+@ns.param('name', 'The servo controller name as configured')
+class Latency(BaseResource):
+    @ns.doc('Latency percentiles of a device, from encoder request to motor command and broadcast')
+    @ns.marshal_with(models.Latency)
+    def get(self, name):
+        device = self.get_device(name)
+        return tracing.get(device.id).to_dict()
@@ -0,0 +1,209 @@
+""" Control quality benchmark: step responses and sidereal tracking of simulated axes.
+
+Every device of a configuration file (config_sample.json by default) is driven by its ServoController
+against a simulated geared stepper, the metrics of each scenario can be saved as a baseline and later runs
+compared against it.
+"""
+import os
+import sys
+import json
+import math
+import argparse
+import datetime
+
+from ethernet_servo.control import devices, simulation, units
+from ethernet_servo.control.control import COUNTS_PER_REVOLUTION
+
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config_sample.json')
+
+# Distance to the target, in arcseconds, within which an axis is settled
+SETTLE_TOLERANCE = 10.0
+# Seconds of tracking ignored at the start while the axis catches up
+TRACKING_WARMUP = 20.0
+
+# A metric regressed if it got worse than the baseline by more than this fraction, plus the absolute slack
+REGRESSION_TOLERANCE = 0.1
+REGRESSION_SLACK = {
+    'settling_time': 0.1,
+    'overshoot': 0.5,
+    'tracking_rms': 0.5,
+    'tracking_max': 1.0,
+    'saturated': 0.01,
+}
+
+# All metrics are better when lower
+METRICS = ['settling_time', 'overshoot', 'tracking_rms', 'tracking_max', 'saturated']
+
+START = datetime.datetime(2020, 1, 1)
+START_TIMESTAMP = START.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def step_scenario(degrees, duration):
+    def scenario(controller, plant):
+        start = controller.position
+        controller.target_angle = controller.position_angle.to_decimal() + degrees
+        target = controller.target_raw
+        return run(controller, plant, duration, target, start)
+    return scenario
+
+
+class SimulatedSkyTarget:
+    """ A fixed right ascension tracked like an AstronomicalPosition, but on the simulated clock.
+
+    The sidereal time is approximated so results do not depend on astropy nor on when the benchmark runs.
+    """
+    def __init__(self, controller, degrees):
+        self.controller = controller
+        self.ra = units.range24(degrees / 15.0 + units.approximate_LST(timestamp=self.timestamp()))
+
+    def timestamp(self):
+        return START_TIMESTAMP + (self.controller._state['old_timestamp'] - START).total_seconds()
+
+    def to_degrees_and_rate(self):
+        degrees = (self.ra - units.approximate_LST(timestamp=self.timestamp())) * 15.0
+        return units.rangeDec(degrees), -units.SIDEREAL_RATE * units.rangeDec_slope(degrees)
+
+    def to_degrees(self):
+        return self.to_degrees_and_rate()[0]
+
+
+def tracking_scenario(duration):
+    def scenario(controller, plant):
+        controller.target_astronomical = SimulatedSkyTarget(controller, controller.position_angle.to_decimal())
+        return run(controller, plant, duration)
+    return scenario
+
+
+SCENARIOS = {
+    'step_small': step_scenario(0.1, 20),
+    'step_large': step_scenario(5.0, 40),
+    'sidereal_tracking': tracking_scenario(120),
+}
+
+
+def run(controller, plant, duration, target=None, start=None):
+    """ Runs a scenario and computes its metrics, with a fixed target for steps or the moving one otherwise """
+    counts_per_arcsecond = controller.ANGLE_TO_RAW / 3600.0
+    max_speed = controller.device.max_speed
+    samples = []
+
+    def record(now):
+        goal = target if target is not None else controller.target_raw
+        samples.append((
+            (now - START).total_seconds(),
+            controller.position - goal,
+            abs(controller._state['speed_hz']) >= max_speed,
+        ))
+
+    began = controller._state['old_timestamp']
+    simulation.run(controller, plant, duration, callback=record)
+    began = (began - START).total_seconds()
+
+    metrics = {
+        'saturated': sum(1 for _, _, saturated in samples if saturated) / len(samples),
+    }
+
+    if target is not None:
+        tolerance = SETTLE_TOLERANCE * counts_per_arcsecond
+        settled_at = None
+        for t, error, _ in samples:
+            if abs(error) > tolerance:
+                settled_at = None
+            elif settled_at is None:
+                settled_at = t
+        metrics['settling_time'] = settled_at - began if settled_at is not None else float('inf')
+
+        direction = 1 if target >= start else -1
+        step = abs(target - start)
+        overshoot = max(0, max(direction * error for _, error, _ in samples))
+        metrics['overshoot'] = 100.0 * overshoot / step if step else 0
+    else:
+        errors = [error / counts_per_arcsecond for t, error, _ in samples if t - began >= TRACKING_WARMUP]
+        metrics['tracking_rms'] = math.sqrt(sum(e * e for e in errors) / len(errors))
+        metrics['tracking_max'] = max(abs(e) for e in errors)
+
+    return metrics
+
+
+def benchmark(device_configs, scenarios=None):
+    """ Runs every scenario on every device, returns {'DEVICE/scenario': metrics} """
+    results = {}
+    for config in device_configs:
+        for name in scenarios or sorted(SCENARIOS):
+            device = devices.Device(**config)
+            plant = simulation.SimulatedPlant(device, position=COUNTS_PER_REVOLUTION // 3)
+            device.serial_interface = plant
+            controller = device.controller
+
+            # Let the controller see the axis at rest before the scenario starts
+            controller.update(plant.encoder_value(), now=START)
+            results['{0}/{1}'.format(device.id, name)] = SCENARIOS[name](controller, plant)
+
+    return results
+
+
+def regressions(results, baseline):
+    """ Metrics worse than in baseline, as (key, metric, baseline value, new value) """
+    found = []
+    for key, metrics in sorted(results.items()):
+        for metric, value in sorted(metrics.items()):
+            reference = baseline.get(key, {}).get(metric)
+            if reference is None:
+                continue
+            limit = reference * (1 + REGRESSION_TOLERANCE) + REGRESSION_SLACK.get(metric, 0)
+            if value > limit:
+                found.append((key, metric, reference, value))
+    return found
+
+
+def load_devices(path):
+    with open(path, 'r') as f:
+        config = json.load(f)
+
+    device_configs = []
+    for device_config in config.get('devices', []):
+        device_configs.append({k: v for k, v in device_config.items() if k not in ('host', 'port')})
+    return device_configs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--config', default=DEFAULT_CONFIG,
+                        help='Configuration file with the devices to simulate. Defaults to config_sample.json')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Scenario to run, can be repeated. Defaults to all of them')
+    parser.add_argument('--baseline', help='Compare against the metrics saved in this file, exits with 1 on regressions')
+    parser.add_argument('--save', help='Save the metrics to this file, to be used as a baseline')
+    parser.add_argument('--json', action='store_true', help='Print the metrics as JSON')
+
+    args = parser.parse_args(argv)
+
+    results = benchmark(load_devices(args.config), args.scenario)
+
+    if args.json:
+        print(json.dumps(results, indent=4, sort_keys=True))
+    else:
+        print('{0:30s} {1}'.format('', ' '.join('{:>14s}'.format(metric) for metric in METRICS)))
+        for key, metrics in sorted(results.items()):
+            print('{0:30s} {1}'.format(key, ' '.join(
+                '{:14.3f}'.format(metrics[metric]) if metric in metrics else '{:>14s}'.format('-')
+                for metric in METRICS)))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+            f.write('\n')
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            found = regressions(results, json.load(f))
+        for key, metric, reference, value in found:
+            print('REGRESSION {0} {1}: {2:.3f} -> {3:.3f}'.format(key, metric, reference, value))
+        if found:
+            sys.exit(1)
+        print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import math
+
+
+# Tuning rules from the ultimate gain and period: (Kp / Ku, Ti / Tu, Td / Tu)
+RULES = {
+    'ziegler-nichols': (0.6, 0.5, 0.125),
+    'some-overshoot': (0.33, 0.5, 0.33),
+    'no-overshoot': (0.2, 0.5, 0.33),
+    'tyreus-luyben': (1 / 2.2, 2.2, 1 / 6.3),
+}
+DEFAULT_RULE = 'tyreus-luyben'
+
+# Derivative filter time constant as a fraction of Td
+DERIVATIVE_FILTER_RATIO = 0.1
+
+
+def pid_gains(Ku, Tu, rule=DEFAULT_RULE, sample_time=None):
+    """ Gains for PidController from the ultimate gain Ku (counts per second per count) and period Tu (s) """
+    kp_ratio, ti_ratio, td_ratio = RULES[rule]
+
+    Kp = kp_ratio * Ku
+    Ti = ti_ratio * Tu
+    Td = td_ratio * Tu
+
+    gains = {
+        'Kp': Kp,
+        'Ki': Kp / Ti,
+        'Kd': Kp * Td,
+    }
+
+    if sample_time:
+        tau = DERIVATIVE_FILTER_RATIO * Td
+        gains['derivative_filtering'] = min(1.0, max(0.05, sample_time / (tau + sample_time)))
+
+    return gains
+
+
+class RelayAutotuner:
+    """ Relay feedback experiment (Astrom-Hagglund) on one axis.
+
+    The output switches between +amplitude and -amplitude (counts per second) whenever the position
+    crosses the center with some hysteresis. The axis settles into a limit cycle whose amplitude and period
+    give the ultimate gain and period of the loop. The experiment fails if the position goes further than
+    max_excursion counts from the center or takes longer than timeout seconds.
+    """
+    def __init__(self, amplitude, max_excursion, hysteresis=0, cycles=4, rule=DEFAULT_RULE, timeout=120):
+        if rule not in RULES:
+            raise ValueError('Unknown tuning rule: {}'.format(rule))
+
+        self.amplitude = abs(amplitude)
+        self.max_excursion = abs(max_excursion)
+        self.hysteresis = abs(hysteresis)
+        self.cycles = max(2, int(cycles))
+        self.rule = rule
+        self.timeout = timeout
+
+        self.center = 0
+        self.output = 0
+        self.elapsed = 0
+        self.switches = []
+        self.peaks = []
+        self.half_cycle_peak = 0
+        self.state = 'idle'
+        self.message = ''
+        self.result = {}
+
+    @property
+    def active(self):
+        return self.state == 'running'
+
+    def start(self, center):
+        self.center = center
+        self.output = self.amplitude
+        self.elapsed = 0
+        self.switches = []
+        self.peaks = []
+        self.half_cycle_peak = 0
+        self.state = 'running'
+        self.message = ''
+        self.result = {}
+
+    def abort(self, message='aborted'):
+        self.output = 0
+        self.state = 'failed'
+        self.message = message
+
+    def process(self, position, dt):
+        """ Returns the relay output in counts per second for the current position """
+        if not self.active:
+            return 0
+
+        self.elapsed += dt
+        deviation = position - self.center
+
+        if abs(deviation) > self.max_excursion:
+            self.abort('position went {0:.0f} counts away from the center'.format(deviation))
+            return 0
+
+        if self.elapsed > self.timeout:
+            self.abort('no stable oscillation after {0:.0f}s'.format(self.timeout))
+            return 0
+
+        if abs(deviation) > abs(self.half_cycle_peak):
+            self.half_cycle_peak = deviation
+
+        if self.output > 0 and deviation > self.hysteresis:
+            self.__switch(-self.amplitude)
+        elif self.output < 0 and deviation < -self.hysteresis:
+            self.__switch(self.amplitude)
+
+        # The first switches only bring the axis into the limit cycle
+        if len(self.switches) >= 2 * self.cycles + 3:
+            self.__identify()
+            self.output = 0
+
+        return self.output
+
+    def __switch(self, output):
+        self.switches.append(self.elapsed)
+        self.peaks.append(self.half_cycle_peak)
+        self.half_cycle_peak = 0
+        self.output = output
+
+    def __identify(self):
+        switches = self.switches[3:]
+        # Peaks are recorded at the end of each half cycle
+        peaks = [abs(peak) for peak in self.peaks[4:]]
+
+        periods = [b - a for a, b in zip(switches[:-2], switches[2:])]
+        Tu = sum(periods) / len(periods)
+        amplitude = sum(peaks) / len(peaks)
+
+        if amplitude <= self.hysteresis or Tu <= 0:
+            self.abort('oscillation too small to identify the axis')
+            return
+
+        Ku = 4.0 * self.amplitude / (math.pi * math.sqrt(amplitude**2 - self.hysteresis**2))
+
+        self.result = {
+            'Ku': Ku,
+            'Tu': Tu,
+            'oscillation': amplitude,
+        }
+        self.state = 'done'
+        self.message = ''
+
+    def gains(self, sample_time=None):
+        if self.state != 'done':
+            return {}
+        return pid_gains(self.result['Ku'], self.result['Tu'], self.rule, sample_time)
+
+    def to_dict(self, sample_time=None):
+        status = {
+            'state': self.state,
+            'message': self.message,
+            'rule': self.rule,
+            'elapsed': self.elapsed,
+            'switches': len(self.switches),
+        }
+        status.update(self.result)
+        status.update(self.gains(sample_time))
+        return status
@@ -0,0 +1,163 @@
+import math
+
+from ethernet_servo.control import devices, units, ephemeris
+
+
+UNITS = ['raw', 'angle', 'astronomical', 'ephemeris']
+
+
+def _number(command, key, default=None):
+    """ command[key] as a finite float, so actions built from it can not fail when applied """
+    value = command.get(key, default)
+    if value is None:
+        raise KeyError(key)
+    if isinstance(value, bool):
+        raise ValueError('{0} must be a number, got {1!r}'.format(key, value))
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('{0} must be a number, got {1!r}'.format(key, value))
+    if not math.isfinite(value):
+        raise ValueError('{0} must be finite'.format(key))
+    return value
+
+
+def _angle(command):
+    return units.AnglePosition(_number(command, 'degrees', 0), _number(command, 'minutes', 0),
+                               _number(command, 'seconds', 0))
+
+
+def _astronomical(command):
+    return units.AstronomicalPosition(_number(command, 'hours', 0), _number(command, 'minutes', 0),
+                                      _number(command, 'seconds', 0))
+
+
+def _ephemeris(command):
+    table = ephemeris.get(command['ephemeris'])
+    if table is None:
+        raise ValueError("Ephemeris '{}' does not exist".format(command['ephemeris']))
+    return ephemeris.EphemerisTarget(table, command.get('coordinate', 'ra'))
+
+
+def _goto(controller, command):
+    position_units = command.get('units', 'raw')
+    if position_units == 'raw':
+        value = _number(command, 'value')
+        return lambda: setattr(controller, 'target_raw', value)
+    if position_units == 'angle':
+        target = _angle(command)
+        return lambda: setattr(controller, 'target_angle', target.to_decimal())
+    if position_units == 'ephemeris':
+        target = _ephemeris(command)
+        return lambda: setattr(controller, 'target_astronomical', target)
+    target = _astronomical(command)
+    return lambda: setattr(controller, 'target_astronomical', target)
+
+
+def _sync(controller, command):
+    position_units = command.get('units', 'raw')
+    if position_units == 'raw':
+        value = _number(command, 'value')
+        return lambda: controller.sync_raw(value)
+    if position_units == 'angle':
+        target = _angle(command)
+        return lambda: controller.sync_angle(target.to_decimal())
+    if position_units == 'ephemeris':
+        raise ValueError('sync does not take ephemeris units')
+    target = _astronomical(command)
+    return lambda: controller.sync_astronomical(target)
+
+
+def _run_speed(controller, command):
+    speed = _angle(command)
+    return lambda: setattr(controller, 'run_speed', speed)
+
+
+def _halt(controller, command):
+    # Imported here, the sequencer applies its steps through this module
+    from ethernet_servo.control import sequencer
+
+    def halt():
+        controller.closed_loop = False
+        controller.tracking = False
+        # However it is sent, a halt stops the sequence moving the device too
+        sequencer.abort(controller.device, 'halted')
+    return halt
+
+
+def _resume(controller, command):
+    return lambda: setattr(controller, 'closed_loop', True)
+
+
+def _reset(controller, command):
+    def reset():
+        controller.tracking = False
+        controller.free_running = False
+        controller.target_raw = controller.position
+    return reset
+
+
+def _tracking(controller, command):
+    tracking = command['tracking']
+    if not isinstance(tracking, bool):
+        raise ValueError('tracking must be true or false, got {!r}'.format(tracking))
+    return lambda: setattr(controller, 'tracking', tracking)
+
+
+PARSERS = {
+    'goto': _goto,
+    'sync': _sync,
+    'run_speed': _run_speed,
+    'halt': _halt,
+    'resume': _resume,
+    'reset': _reset,
+    'tracking': _tracking,
+}
+COMMANDS = sorted(PARSERS)
+
+
+def parse(command):
+    """ Validates a device command and returns (device, action) where action() applies it.
+
+    A command is a dict with the device id, the command name and its arguments, ie:
+    {'device': 'RA', 'command': 'goto', 'units': 'astronomical', 'hours': 3, 'minutes': 20, 'seconds': 0}
+    Raises ValueError if it is not valid, numeric arguments are converted here so action() does not fail.
+    """
+    if not isinstance(command, dict):
+        raise ValueError('Commands must be objects, got {!r}'.format(command))
+
+    device_id = command.get('device')
+    device = devices.get(device_id) if device_id is not None else None
+    if device is None:
+        raise ValueError("Device '{}' does not exist".format(device_id))
+
+    name = command.get('command')
+    if name not in COMMANDS:
+        raise ValueError("Unknown command '{}'".format(name))
+
+    if command.get('units', 'raw') not in UNITS:
+        raise ValueError("Unknown units '{}'".format(command.get('units')))
+
+    parser = PARSERS[name]
+    try:
+        action = parser(device.controller, command)
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError("Invalid arguments for '{0}' on '{1}': {2}".format(name, device.id, e))
+
+    return device, action
+
+
+def apply_batch(commands):
+    """ Applies every command or none of them if any is invalid, returns the devices involved.
+
+    Nothing yields between commands so no control cycle sees only some of them applied.
+    """
+    parsed = [parse(command) for command in commands]
+
+    involved = []
+    for device, action in parsed:
+        action()
+        if all(device is not other for other in involved):
+            involved.append(device)
+
+    return involved
@@ -1,10 +1,18 @@
+import time
 import datetime
+import threading
 from collections import deque
 import logging
 
 import serial
 
+from ethernet_servo import profiling
 from ethernet_servo.control.units import AnglePosition, AstronomicalPosition
+from ethernet_servo.control.trajectory import TrapezoidalProfile
+from ethernet_servo.control.autotune import RelayAutotuner, DEFAULT_RULE
+from ethernet_servo.control.polling import PollingPolicy
+from ethernet_servo.control.scheduling import GainSchedule
+from ethernet_servo.control.correction import CorrectionTable, DEFAULT_LEARNING_GAIN
 
 log = logging.getLogger('ethernet-encoder-servo')
 
@@ -12,6 +20,17 @@ STEPS_PER_REVOLUTION = 25600
 COUNTS_PER_REVOLUTION = 262144
 COUNTS_PER_STEP = 1.0 * COUNTS_PER_REVOLUTION / STEPS_PER_REVOLUTION
 
+# Fraction of max_speed used for gotos when max_slew_speed is not configured
+DEFAULT_SLEW_SPEED_FACTOR = 0.9
+# Seconds to reach the slew speed when max_acceleration is not configured
+DEFAULT_ACCELERATION_TIME = 2.0
+# Encoder moves faster than max_speed times this are glitches, not motion
+MAX_SPEED_MARGIN = 1.5
+# Consecutive glitches after which the encoder reading is trusted again
+MAX_REJECTED_SAMPLES = 3
+# Derivative term below which an idle PID is considered settled
+SETTLED_DTERM = 1e-6
+
 
 def cps_to_hz(cps, counts_per_step=COUNTS_PER_STEP):
     """ Converts encoder counts per second to step rate in hertz"""
@@ -22,36 +41,127 @@ def hz_to_cps(hz, counts_per_step=COUNTS_PER_STEP):
     return counts_per_step * hz
 
 
+# Serial link settings used when a device does not set its own
+DEFAULT_SERIAL_PORT = '/dev/ttyACM0'
+DEFAULT_BAUDRATE = 57600
+SERIAL_WRITE_TIMEOUT = 0.05
+# Seconds between attempts to reopen a serial port, doubled on every failure up to the max
+SERIAL_RECONNECT_INTERVAL = 0.5
+SERIAL_RECONNECT_MAX = 5.0
+
+__serial_ports = {}
+
+
 class SerialPortInterface:
-    def __init__(self, serial_path='/dev/ttyUSB0'):
+    """ A step/direction board on a serial port, written to by its own writer.
+
+    update_stepper_frequency() only records the latest speed of the axis and returns, the writer sends the
+    latest speed of every axis that changed and reopens the port with a growing delay when it goes away, so
+    a slow or disconnected board never holds up a control cycle. on_written(time) is called with the monotonic
+    time the speed was sent, speeds replaced before being sent never call it.
+
+    The writer is a threading.Thread, that is a greenlet once the server monkey patches threading. pyserial
+    waits for the port with select(), which gevent makes cooperative, but flush() drains it with tcdrain(),
+    which blocks the whole process until the bytes are out: about 1.7 ms for each axis line at 57600 baud.
+    """
+    def __init__(self, serial_path=DEFAULT_SERIAL_PORT, baudrate=DEFAULT_BAUDRATE):
         self.serial_path = serial_path
+        self.baudrate = baudrate
         self.serial_port = None
+        self.writes = 0
+        self.connects = 0
+        self.__pending = {}
+        self.__condition = threading.Condition()
+        self.__writer = None
+
+    @property
+    def connected(self):
+        return self.serial_port is not None
 
     def __open(self):
-        self.serial_port = serial.Serial(self.serial_path, baudrate=57600)
-        self.serial_port.write_timeout = 0.05
-        self.serial_port.read_timeout = 0.05
-        log.info('serial port connected')
+        self.serial_port = serial.Serial(self.serial_path, baudrate=self.baudrate)
+        self.serial_port.write_timeout = SERIAL_WRITE_TIMEOUT
+        self.serial_port.read_timeout = SERIAL_WRITE_TIMEOUT
+        self.connects += 1
+        log.info('serial port %s connected', self.serial_path)
 
-    def update_stepper_frequency(self, freq, device):
-        if not self.serial_port:
-            try:
-                self.__open()
-            except:
-                return
+    def __close(self):
+        try:
+            self.serial_port.close()
+        except serial.SerialException:
+            pass
+        self.serial_port = None
 
+    def update_stepper_frequency(self, freq, device, on_written=None):
         freq = saturate(freq, device.max_speed)
 
-        payload = '\n{0}{1:-7.0f}\n'.format(device.axis, freq).encode('ascii')
-        try:
-            self.serial_port.write(payload)
-            self.serial_port.flush()
-        except serial.SerialTimeoutException:
-            log.info('serial port write timeout')
-        except serial.SerialException:
-            log.info('serial port disconnected')
-            self.serial_port.close()
-            self.serial_port = None
+        with self.__condition:
+            self.__pending[device.axis] = (freq, on_written)
+            if self.__writer is None:
+                self.__writer = threading.Thread(target=self.__write_loop, name='serial {}'.format(self.serial_path),
+                                                 daemon=True)
+                self.__writer.start()
+            self.__condition.notify()
+
+    def __write_loop(self):
+        delay = SERIAL_RECONNECT_INTERVAL
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.__pending)
+                pending, self.__pending = self.__pending, {}
+
+            if not self.serial_port:
+                try:
+                    self.__open()
+                    delay = SERIAL_RECONNECT_INTERVAL
+                except (serial.SerialException, OSError) as e:
+                    log.debug('serial port %s: %s', self.serial_path, e)
+                    # Keep the speeds to send once connected, unless newer ones came meanwhile
+                    with self.__condition:
+                        pending.update(self.__pending)
+                        self.__pending = pending
+                    time.sleep(delay)
+                    delay = min(delay * 2, SERIAL_RECONNECT_MAX)
+                    continue
+
+            payload = ''.join(
+                '\n{0}{1:-7.0f}\n'.format(axis, freq) for axis, (freq, _) in pending.items()).encode('ascii')
+            try:
+                self.serial_port.write(payload)
+                self.serial_port.flush()
+                self.writes += 1
+                written = time.monotonic()
+                for _, on_written in pending.values():
+                    if on_written is not None:
+                        on_written(written)
+            except serial.SerialTimeoutException:
+                log.info('serial port %s write timeout', self.serial_path)
+            except serial.SerialException:
+                log.info('serial port %s disconnected', self.serial_path)
+                self.__close()
+
+    def to_dict(self):
+        return {
+            'path': self.serial_path,
+            'baudrate': self.baudrate,
+            'connected': self.connected,
+            'writes': self.writes,
+            'connects': self.connects,
+        }
+
+
+def get_serial_interface(serial_path=DEFAULT_SERIAL_PORT, baudrate=DEFAULT_BAUDRATE):
+    """ The interface of a serial port, shared by every device on it """
+    interface = __serial_ports.get(serial_path)
+    if interface is None:
+        interface = __serial_ports[serial_path] = SerialPortInterface(serial_path, baudrate)
+    elif interface.baudrate != baudrate:
+        log.warning('serial port %s is already used at %s baud, ignoring %s', serial_path, interface.baudrate, baudrate)
+    return interface
+
+
+def get_serial_interfaces():
+    return list(__serial_ports.values())
 
 
 def slew_rate_limit(next_value, current_value, slew_rate):
@@ -74,8 +184,10 @@ class SlewRateLimiter:
         self.slew_rate = slew_rate
         self.current_value = initial_value
 
-    def process(self, next_value):
-        output = slew_rate_limit(next_value, self.current_value, self.slew_rate)
+    def process(self, next_value, scale=1.0):
+        """ Follows next_value changing at most slew_rate times scale """
+        slew_rate = self.slew_rate * scale if self.slew_rate is not None else None
+        output = slew_rate_limit(next_value, self.current_value, slew_rate)
         self.current_value = output
         return output
 
@@ -121,6 +233,15 @@ class MovingAverage:
             self.average = sum(non_zero) / len(non_zero)
         return self.average
 
+    @property
+    def delay(self):
+        """ Samples the average lags behind an input changing at a steady rate """
+        return (len(self.q) - 1) / 2.0
+
+    def settled(self, value):
+        """ True if the window only holds value, so processing it again gives the same average """
+        return len(self.q) == self.q.maxlen and all(x == value for x in self.q)
+
 
 def deadband(value, max_limit, min_limit=None):
     if max_limit is None:
@@ -162,6 +283,45 @@ class IIRLp:
         return output
 
 
+class Unwrapper:
+    """ Turns encoder readings, which wrap every revolution, into a multi-turn position.
+
+    The number of turns between two readings is the one closest to what the estimated velocity predicts
+    for the elapsed time, so it stays right with missed samples as long as the prediction is off by less
+    than half a revolution. Readings implying a speed over max_velocity (counts per second) are rejected
+    and counted in jumps, unless several come in a row.
+    """
+    def __init__(self, max_velocity=None, smoothing=0.5):
+        self.max_velocity = max_velocity
+        self.smoothing = smoothing
+        self.velocity = 0
+        self.jumps = 0
+        self.rejected = 0
+        self.elapsed = 0
+
+    def process(self, position, last_value, value, dt):
+        """ Returns the new position and whether value was accepted """
+        self.elapsed += dt
+        expected = self.velocity * self.elapsed
+
+        dv = value - last_value
+        dv += round((expected - dv) / COUNTS_PER_REVOLUTION) * COUNTS_PER_REVOLUTION
+
+        if self.max_velocity and self.elapsed > 0 and abs(dv) > self.max_velocity * self.elapsed:
+            self.rejected += 1
+            if self.rejected < MAX_REJECTED_SAMPLES:
+                self.jumps += 1
+                log.warning('Encoder jumped %d counts in %.3fs, ignored', dv, self.elapsed)
+                return position, False
+            log.warning('Encoder jumped %d counts, following it', dv)
+
+        if self.elapsed > 0:
+            self.velocity = self.smoothing * (dv / self.elapsed) + (1 - self.smoothing) * self.velocity
+        self.rejected = 0
+        self.elapsed = 0
+        return position + dv, True
+
+
 class PidController:
     def __init__(self, P=1.8, I=1.0, D=1.0, saturation_limit=None, sample_time=1.0/10, slew_rate=None, deadband=None):
 
@@ -171,6 +331,8 @@ class PidController:
         self.windup_guard = 4000
         self.sample_time = sample_time
         self.slew_rate = slew_rate
+        # Seconds slew_rate is the limit for, the limit is scaled to each sample_time. None applies it per update.
+        self.slew_rate_period = None
         self.saturation_limit = saturation_limit
 
         self.derivative_filter = IIRLp()
@@ -190,6 +352,7 @@ class PidController:
 
         self.is_saturated = False
         self.last_output = 0
+        self.unlimited_output = 0
         self.last_error = 0
         self.last_input = 0
 
@@ -209,6 +372,38 @@ class PidController:
     def derivative_filtering(self, alpha):
         self.derivative_filter.alpha = alpha
 
+    @property
+    def deadband_limit(self):
+        return self.deadband.max_limit
+
+    @deadband_limit.setter
+    def deadband_limit(self, value):
+        self.deadband.max_limit = value
+
+    def transfer(self, Kp, Ki, Kd):
+        """ Changes the gains without a bump in the output: the integral term takes up the difference.
+
+        With a Ki of 0 there is no integral term to take it up and the output jumps by what it contributed.
+        """
+        before = self.Kp * self.last_error + self.Ki * self.ITerm + self.Kd * self.DTerm
+
+        self.Kp = Kp
+        self.Ki = Ki
+        self.Kd = Kd
+
+        if Ki:
+            self.ITerm = saturate((before - Kp * self.last_error - Kd * self.DTerm) / Ki, self.windup_guard)
+
+    def settled(self):
+        """ True if an update with the same input gives the same output: no error out of the deadband, no
+        derivative left and the slew rate limiter caught up with the output asked for
+        """
+        return (
+            self.last_error == 0 and
+            abs(self.DTerm) < SETTLED_DTERM and
+            self.slew_rate_limiter.current_value == self.unlimited_output
+        )
+
     def update(self, feedback_value):
 
         #error = self.slew_rate_limiter.process(self.SetPoint) - feedback_value
@@ -226,8 +421,10 @@ class PidController:
         self.last_input = feedback_value
 
         output = self.PTerm + (self.Ki * self.ITerm) + (self.Kd * self.DTerm)
+        self.unlimited_output = output
 
-        output = self.slew_rate_limiter.process(output)
+        scale = self.sample_time / self.slew_rate_period if self.slew_rate_period else 1.0
+        output = self.slew_rate_limiter.process(output, scale)
         limited_output = saturate(output, self.saturation_limit)
         if limited_output != output:
             self.is_saturated = True
@@ -260,13 +457,43 @@ class ServoController:
             'dt': device.interval / 1000,
             'offset': 0,
             'run_speed_raw': 0,     # raw counts per second
+            'feedforward_cps': 0,
+            'encoder_jumps': 0,
         }
 
         self.position_filter = MovingAverage(length=3)
+        self.unwrapper = Unwrapper(MAX_SPEED_MARGIN * hz_to_cps(device.max_speed, 1.0 * COUNTS_PER_REVOLUTION / device.steps))
         self.pid_controller = PidController(slew_rate=SLEW_RATE_LIMIT, saturation_limit=hz_to_cps(device.max_speed, device.steps), deadband=DEADBAND_LIMIT)
         self.pid_controller.sample_time = device.interval / 1000
+        # SLEW_RATE_LIMIT and max_slew_rate are per configured interval, polling faster or slower keeps the same rate
+        self.pid_controller.slew_rate_period = device.interval / 1000
         self._astronomical_target = None
+        self.polling = PollingPolicy(device.interval, device.min_interval, device.max_interval, device.interval_hold)
+        self.schedule = GainSchedule(device.gain_schedule, device.settle_time)
+        # Parameters used where the schedule does not change them, and the regime they are applied for
+        self.base_gains = {'deadband': DEADBAND_LIMIT}
+        self.regime = 'holding'
+
+        counts_per_step = 1.0 * COUNTS_PER_REVOLUTION / device.steps
+        if device.max_slew_speed is not None:
+            max_velocity = device.max_slew_speed * self.ANGLE_TO_RAW
+        else:
+            max_velocity = DEFAULT_SLEW_SPEED_FACTOR * hz_to_cps(device.max_speed, counts_per_step)
 
+        if device.max_acceleration is not None:
+            max_acceleration = device.max_acceleration * self.ANGLE_TO_RAW
+        else:
+            max_acceleration = max_velocity / DEFAULT_ACCELERATION_TIME
+
+        self.trajectory = TrapezoidalProfile(max_velocity, max_acceleration)
+        self.feedforward = device.feedforward
+        self.autotuner = None
+        self.autotune_apply = False
+        # Set when the last update() found nothing to do, see __is_idle()
+        self.idle = False
+        # Monotonic times the last speed command was computed and sent to the motor
+        self.computed_at = None
+        self.__idle_key = None
 
         self.set_control_parameters({
             # 'max_slew_rate': device.max_slew_rate,
@@ -276,9 +503,17 @@ class ServoController:
             'Kd': device.Kd
         })
 
-        if device.initial_state:
-            self._state.update(device.initial_state)
-            self.set_control_parameters(device.initial_state)
+        # Periodic error and backlash correction, a learned table in the saved state wins over the configured one.
+        # It is saved next to the state but not part of it, telemetry would carry the whole table otherwise.
+        initial_state = dict(device.initial_state or {})
+        self.correction = None
+        correction = initial_state.pop('correction', None) or device.correction
+        if correction:
+            self.set_correction(correction)
+
+        if initial_state:
+            self._state.update(initial_state)
+            self.set_control_parameters(initial_state)
 
         self.pid_controller.SetPoint = self._state.get('target', 0)
         self._state['tracking'] = False
@@ -287,10 +522,72 @@ class ServoController:
 
     def set_control_parameters(self, parameters):
         controller = self.pid_controller
-        params = ['max_slew_rate', 'derivative_filtering', 'Kp', 'Ki', 'Kd']
-        for param in params:
+        if 'max_slew_rate' in parameters:
+            controller.max_slew_rate = parameters['max_slew_rate']
+
+        for param in ['derivative_filtering', 'Kp', 'Ki', 'Kd']:
             if param in parameters:
-                setattr(controller, param, parameters[param])
+                self.base_gains[param] = parameters[param]
+
+        if parameters.get('gain_schedule', None) is not None:
+            self.schedule.update(parameters['gain_schedule'])
+
+        self.apply_gains(self.regime)
+
+        for param in ['max_slew_speed', 'max_acceleration', 'feedforward']:
+            if parameters.get(param, None) is not None:
+                setattr(self, param, parameters[param])
+
+    def apply_gains(self, regime):
+        """ Switches the PID to the parameters of a regime, see GainSchedule """
+        gains = self.schedule.gains(regime, self.base_gains)
+        controller = self.pid_controller
+        controller.transfer(gains['Kp'], gains['Ki'], gains['Kd'])
+        controller.derivative_filtering = gains['derivative_filtering']
+        controller.deadband_limit = gains['deadband']
+        self.regime = regime
+
+    def set_correction(self, parameters):
+        """ Replaces the correction table if period, values or bins are given, otherwise changes its settings """
+        if self.correction is None or any(parameters.get(key) is not None for key in ('period', 'values', 'bins')):
+            correction = CorrectionTable.from_dict(parameters, COUNTS_PER_REVOLUTION)
+        else:
+            correction = self.correction
+            if parameters.get('backlash') is not None:
+                correction.backlash = float(parameters['backlash'])
+            if parameters.get('enabled') is not None:
+                correction.enabled = bool(parameters['enabled'])
+
+        if parameters.get('recording') is not None:
+            correction.recording = bool(parameters['recording'])
+        self.correction = correction
+
+    def clear_correction(self):
+        self.correction = None
+
+    def learn_correction(self, gain=DEFAULT_LEARNING_GAIN):
+        """ Improves the correction table with what was recorded, see CorrectionTable.learn() """
+        if self.correction is None:
+            raise ValueError('There is no correction table')
+        self.correction.learn(gain)
+
+    @property
+    def max_slew_speed(self):
+        """ Maximum goto speed in degrees per second """
+        return self.trajectory.max_velocity * self.RAW_TO_ANGLE
+
+    @max_slew_speed.setter
+    def max_slew_speed(self, speed):
+        self.trajectory.max_velocity = speed * self.ANGLE_TO_RAW
+
+    @property
+    def max_acceleration(self):
+        """ Maximum goto acceleration in degrees per second squared """
+        return self.trajectory.max_acceleration * self.RAW_TO_ANGLE
+
+    @max_acceleration.setter
+    def max_acceleration(self, acceleration):
+        self.trajectory.max_acceleration = acceleration * self.ANGLE_TO_RAW
 
     @property
     def state(self):
@@ -303,15 +600,31 @@ class ServoController:
             'position_angle': self.position_angle,
             'position_astronomical': self.position_astronomical,
             'run_speed': self.run_speed,
+            'slewing': self.trajectory.active,
+            'setpoint': self.pid_controller.SetPoint - self._state['offset'],
+            'regime': self.regime,
             'pid': {
-                'Kp': self.pid_controller.Kp,
-                'Ki': self.pid_controller.Ki,
-                'Kd': self.pid_controller.Kd,
-                'derivative_filtering': self.pid_controller.derivative_filtering,
+                'Kp': self.base_gains['Kp'],
+                'Ki': self.base_gains['Ki'],
+                'Kd': self.base_gains['Kd'],
+                'derivative_filtering': self.base_gains['derivative_filtering'],
+                'gain_schedule': self.schedule.to_dict(),
+                'active_gains': {
+                    'Kp': self.pid_controller.Kp,
+                    'Ki': self.pid_controller.Ki,
+                    'Kd': self.pid_controller.Kd,
+                    'derivative_filtering': self.pid_controller.derivative_filtering,
+                    'deadband': self.pid_controller.deadband_limit,
+                },
                 'max_slew_rate': self.pid_controller.max_slew_rate,
+                'max_slew_speed': self.max_slew_speed,
+                'max_acceleration': self.max_acceleration,
+                'feedforward': self.feedforward,
             },
             'error': self.pid_controller.last_error,
             'output': self.pid_controller.last_output,
+            'autotune': self.autotune_status,
+            'polling': self.polling.to_dict(),
         })
         state.pop('old_timestamp', None)
         return state
@@ -345,6 +658,7 @@ class ServoController:
             run_speed_raw = speed.to_decimal() * self.ANGLE_TO_RAW
 
         self._state['run_speed_raw'] = run_speed_raw
+        self.__stop_trajectory()
         if run_speed_raw != 0:
             self.free_running = True
             self.closed_loop = True
@@ -361,21 +675,36 @@ class ServoController:
         self._state['closed_loop'] = bool(value)
         if not value:
             self.free_running = False
+            self.__stop_trajectory()
 
     @property
     def target_raw(self):
+        if self.trajectory.active:
+            return self.trajectory.goal - self._state['offset']
         return self.pid_controller.SetPoint - self._state['offset']
 
     @target_raw.setter
     def target_raw(self, raw_target):
+        """ Moves to raw_target following a velocity and acceleration limited trajectory """
+        velocity = self.trajectory.velocity if self.trajectory.active else 0
+        self.trajectory.start(self.pid_controller.SetPoint, raw_target + self._state['offset'], velocity)
         self.closed_loop = True
         self.free_running = False
         return self.__set_target_raw(raw_target)
 
     def __set_target_raw(self, raw_target):
-        self.pid_controller.SetPoint = raw_target + self._state['offset']
+        if self.trajectory.active:
+            self.trajectory.goal = raw_target + self._state['offset']
+        else:
+            self.pid_controller.SetPoint = raw_target + self._state['offset']
         self._astronomical_target = AstronomicalPosition.from_degrees(self.target_angle.to_decimal())
 
+    def __stop_trajectory(self):
+        """ Holds the current trajectory setpoint as the new target """
+        if self.trajectory.active:
+            self.pid_controller.SetPoint = self.trajectory.position
+            self.trajectory.stop()
+
     @property
     def target_angle(self):
         target = self.target_raw * self.RAW_TO_ANGLE
@@ -392,7 +721,7 @@ class ServoController:
     def target_astronomical(self):
         if self._astronomical_target is not None:
             return self._astronomical_target
-        return AstronomicalPosition.from_degrees(self.target_angle.to_decimal())
+        return AstronomicalPosition.from_degrees(self.target_angle.to_decimal(), deferred=True)
 
     @target_astronomical.setter
     def target_astronomical(self, target):
@@ -411,7 +740,87 @@ class ServoController:
 
     @property
     def position_astronomical(self):
-        return AstronomicalPosition.from_degrees(self.position_angle.to_decimal())
+        return AstronomicalPosition.from_degrees(self.position_angle.to_decimal(), deferred=True)
+
+    def start_autotune(self, amplitude, max_excursion, cycles=4, rule=DEFAULT_RULE, apply=False):
+        """ Identifies this axis with a relay experiment around the current position.
+
+        amplitude is the relay speed in degrees per second and max_excursion the maximum distance from the
+        current position in degrees. If apply is True the proposed gains are used once it finishes.
+        """
+        deadband = self.pid_controller.deadband.max_limit or 0
+        self.autotuner = RelayAutotuner(
+            amplitude=amplitude * self.ANGLE_TO_RAW,
+            max_excursion=max_excursion * self.ANGLE_TO_RAW,
+            hysteresis=2 * deadband,
+            cycles=cycles,
+            rule=rule,
+        )
+        self.autotune_apply = apply
+
+        self.tracking = False
+        self.free_running = False
+        self.__stop_trajectory()
+        self.closed_loop = True
+        self.__set_target_raw(self.position)
+        self.autotuner.start(self.position_filter.average)
+
+    def apply_autotune(self):
+        """ Uses the gains proposed by the last autotune run, returns them """
+        gains = {}
+        if self.autotuner is not None:
+            gains = self.autotuner.gains(self.pid_controller.sample_time)
+            self.set_control_parameters(gains)
+        return gains
+
+    def stop_autotune(self):
+        if self.autotuner is not None and self.autotuner.active:
+            self.autotuner.abort()
+            self.__autotune_finished()
+
+    @property
+    def autotune_status(self):
+        if self.autotuner is None:
+            return {'state': 'idle'}
+        status = self.autotuner.to_dict(self.pid_controller.sample_time)
+        status['apply'] = self.autotune_apply
+        return status
+
+    def __autotune_finished(self):
+        if self.autotuner.state == 'done' and self.autotune_apply:
+            gains = self.apply_autotune()
+            log.info('Autotune of %s finished, applied %s', self.device.id, gains)
+        else:
+            log.info('Autotune of %s %s %s', self.device.id, self.autotuner.state, self.autotuner.message)
+        self.pid_controller.ITerm = 0
+
+    def digest(self):
+        """ The parts of the state clients see that change without a command, to tell whether a cycle changed it.
+        Timestamps and positions derived from sidereal time are left out, tracking moves the setpoint anyway.
+        """
+        state = self._state
+        pid = self.pid_controller
+        return (state['position'], state['offset'], state['closed_loop'], state['tracking'], state['free_running'],
+                state['encoder_jumps'], pid.SetPoint, pid.last_error, pid.last_output, self.trajectory.active,
+                self.regime, self.polling.mode)
+
+    @property
+    def polling_mode(self):
+        """ How often this axis needs to be polled right now, see PollingPolicy """
+        state = self._state
+        moving = abs(self.unwrapper.velocity) > 1.0 * COUNTS_PER_REVOLUTION / self.device.steps
+
+        if not state['closed_loop']:
+            return 'normal' if moving else 'idle'
+
+        autotuning = self.autotuner is not None and self.autotuner.active
+        if self.trajectory.active or state['free_running'] or autotuning or self.pid_controller.last_error:
+            return 'fast'
+
+        if state['tracking'] or moving:
+            return 'normal'
+
+        return 'idle'
 
     def sync_raw(self, real_raw_position):
         self._state['offset'] = self._state['position'] - real_raw_position
@@ -423,55 +832,125 @@ class ServoController:
         self.tracking = True
         return self.sync_raw(real_astronomical_position.to_degrees() * self.ANGLE_TO_RAW)
 
-    def update(self, feedback_value):
+    def __is_idle(self, feedback_value):
+        """ True if the encoder did not move and nothing was commanded since the last cycle, while parked.
+
+        In closed loop the PID must have settled too, a slew limited output still ramping or an error out of the
+        deadband would be frozen otherwise.
+        """
+        state = self._state
+        idle_key = (feedback_value, state['closed_loop'], state['offset'], self.pid_controller.SetPoint)
+        return (
+            idle_key == self.__idle_key and
+            self.polling_mode == 'idle' and
+            self.position_filter.settled(state['position']) and
+            (not state['closed_loop'] or self.pid_controller.settled())
+        )
+
+    def update(self, feedback_value, now=None, on_written=None):
+        """ Runs a control cycle on an encoder reading, on_written(time) is called once its speed was sent """
         state = self._state
         device = self.device
 
-        now = datetime.datetime.now()
-        now_formatted = now.isoformat()
+        if now is None:
+            now = datetime.datetime.now()
 
         if device.invert:
             feedback_value = COUNTS_PER_REVOLUTION - feedback_value
 
+        # Same input and same mode give the same output, skip the filters, PID and conversions
+        self.idle = self.__is_idle(feedback_value)
+        if self.idle:
+            if state['old_timestamp'] is not None:
+                state['dt'] = (now - state['old_timestamp']).total_seconds()
+            state['old_timestamp'] = now
+            self.polling.process('idle', state['dt'])
+            return state['speed_hz']
+
         if state['old_value'] is None:
             state['position'] = feedback_value
             state['old_value'] = feedback_value
 
-        new_position = state['position']
-        dv = feedback_value - state['old_value']
-        dv_abs = abs(dv)
-        dv_wrapped = min(dv_abs, min((dv % COUNTS_PER_REVOLUTION), (COUNTS_PER_REVOLUTION - dv_abs)))
-
-        if dv_wrapped == dv_abs:
-            new_position += 1*dv
-        else:
-            if dv >= 0:
-                dv_wrapped = -1 * dv_wrapped
-
-            new_position += 1*dv_wrapped
-
-        state['position'] = new_position
-        state['old_value'] = feedback_value
-
-        position = self.position_filter.process(new_position)
-
         if state['old_timestamp'] is not None:
             state['dt'] = (now - state['old_timestamp']).total_seconds()
+            if state['dt'] > 0:
+                # The polling interval changes, integrate over the time that really went by
+                self.pid_controller.sample_time = state['dt']
 
         state['old_timestamp'] = now
-        # FIXME XXX device['timestamp'] = now_formatted
-
-        if state['tracking'] and not state['free_running']:
-            # WARNING: keep it this way so we do not loose the original Astronomical Target
-            self.pid_controller.SetPoint = self.target_astronomical.to_degrees() * self.ANGLE_TO_RAW
 
-        if state['free_running']:
-            self.__set_target_raw(self.target_raw + state['run_speed_raw'] * state['dt'])
-
-        if not state['closed_loop']:
-            self.__set_target_raw(self.position)
-
-        new_cps = self.pid_controller.update(position)
+        with profiling.stage('update.unwrap'):
+            new_position, accepted = self.unwrapper.process(state['position'], state['old_value'], feedback_value, state['dt'])
+        if accepted:
+            state['position'] = new_position
+            state['old_value'] = feedback_value
+        state['encoder_jumps'] = self.unwrapper.jumps
+
+        with profiling.stage('update.filter'):
+            position = self.position_filter.process(state['position'])
+
+        # Known rate of change of the setpoint in counts per second, fed ahead of the PID
+        feedforward_cps = 0
+
+        with profiling.stage('update.units'):
+            # Ephemeris targets run out, hold where the last position left the axis instead of following a frozen one
+            covers = getattr(self._astronomical_target, 'covers', None)
+            if state['tracking'] and covers is not None and not covers():
+                log.warning('%s: ephemeris %s ended, tracking stopped', self.device.id,
+                            self._astronomical_target.ephemeris.name)
+                state['tracking'] = False
+
+            if state['tracking'] and not state['free_running']:
+                # WARNING: keep it this way so we do not loose the original Astronomical Target
+                degrees, rate = self.target_astronomical.to_degrees_and_rate()
+                target = degrees * self.ANGLE_TO_RAW + state['offset']
+                feedforward_cps = rate * self.ANGLE_TO_RAW
+                if self.trajectory.active:
+                    self.trajectory.goal = target
+                else:
+                    self.pid_controller.SetPoint = target
+
+            if state['free_running']:
+                self.__set_target_raw(self.target_raw + state['run_speed_raw'] * state['dt'])
+                feedforward_cps = state['run_speed_raw']
+
+            if not state['closed_loop']:
+                self.__set_target_raw(self.position)
+
+        if self.trajectory.active:
+            self.pid_controller.SetPoint = self.trajectory.step(state['dt'])
+            feedforward_cps = self.trajectory.velocity
+
+        state['feedforward_cps'] = feedforward_cps
+
+        # The moving average lags behind a moving axis, the PID would hold it ahead of the setpoint by that much.
+        # Moving at the rate of the setpoint it is this far ahead of the average.
+        position += feedforward_cps * self.position_filter.delay * state['dt']
+
+        regime = self.schedule.regime(self.trajectory.active, state['free_running'], state['tracking'], now)
+        if regime != self.regime:
+            self.apply_gains(regime)
+
+        # The PID sees the position minus the correction, as if the correction had been added to the setpoint
+        feedback = position
+        if self.correction is not None:
+            if self.correction.recording and regime in ('tracking', 'free_running'):
+                self.correction.record(state['position'], position - self.pid_controller.SetPoint)
+            correction, correction_cps = self.correction.correction(state['position'], feedforward_cps)
+            feedback = position - correction
+            feedforward_cps += correction_cps
+
+        with profiling.stage('update.pid'):
+            new_cps = self.pid_controller.update(feedback)
+            if self.feedforward:
+                new_cps = saturate(new_cps + self.feedforward * feedforward_cps, self.pid_controller.saturation_limit)
+
+        if self.autotuner is not None and self.autotuner.active:
+            new_cps = self.autotuner.process(position, state['dt'])
+            if not self.autotuner.active:
+                self.__autotune_finished()
+
+        self.computed_at = time.monotonic()
 
         if state['closed_loop']:
             if device.invert:
@@ -480,9 +959,13 @@ class ServoController:
             counts_per_step = 1.0 * COUNTS_PER_REVOLUTION / device.steps
             new_speed = cps_to_hz(new_cps, counts_per_step)
 
-            device.serial_interface.update_stepper_frequency(new_speed, device)
+            with profiling.stage('serial'):
+                device.serial_interface.update_stepper_frequency(new_speed, device, on_written)
 
             state['speed_cps'] = new_cps
             state['speed_hz'] = new_speed
 
+        self.polling.process(self.polling_mode, state['dt'])
+        self.__idle_key = (feedback_value, state['closed_loop'], state['offset'], self.pid_controller.SetPoint)
+
         return state['speed_hz']
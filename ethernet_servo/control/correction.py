@@ -0,0 +1,108 @@
+# Default number of points of a periodic error table
+DEFAULT_BINS = 128
+# Fraction of the recorded error added to the table on every learning pass
+DEFAULT_LEARNING_GAIN = 0.5
+# Recorded samples each point needs before the table can learn from a recording
+MIN_SAMPLES_PER_BIN = 3
+
+
+class CorrectionTable:
+    """ Periodic error and backlash correction of one axis, in encoder counts.
+
+    values are corrections added to the setpoint at evenly spaced phases of period counts of the unwrapped
+    encoder position (one worm revolution, for instance), interpolated in between. backlash is added half in
+    the direction of the last commanded motion so reversals take up the slack.
+
+    While recording, tracking errors are averaged for every point of the table and learn() folds their
+    periodic part into it, so the table gets better with every recorded run.
+    """
+    def __init__(self, period, values=None, bins=DEFAULT_BINS, backlash=0, enabled=True):
+        if period <= 0:
+            raise ValueError('The period must be positive')
+
+        self.period = float(period)
+        self.backlash = float(backlash)
+        self.enabled = bool(enabled)
+        self.values = [float(v) for v in values] if values else [0.0] * int(bins)
+        if len(self.values) < 2:
+            raise ValueError('A correction table needs at least two values')
+
+        self.direction = 0
+        self.recording = False
+        self.__precompute()
+        self.clear_recording()
+
+    def __precompute(self):
+        n = len(self.values)
+        self.bin_size = self.period / n
+        self.slopes = [(self.values[(i + 1) % n] - self.values[i]) / self.bin_size for i in range(n)]
+
+    def __locate(self, position):
+        phase = (position % self.period) / self.bin_size
+        index = int(phase)
+        if index >= len(self.values):
+            index = 0
+        return index, phase - index
+
+    def correction(self, position, velocity):
+        """ Setpoint correction at position and how fast it changes moving at velocity, both in counts """
+        if not self.enabled:
+            return 0.0, 0.0
+
+        index, fraction = self.__locate(position)
+        slope = self.slopes[index]
+        offset = self.values[index] + slope * fraction * self.bin_size
+
+        if velocity > 0:
+            self.direction = 1
+        elif velocity < 0:
+            self.direction = -1
+        offset += 0.5 * self.backlash * self.direction
+
+        return offset, slope * velocity
+
+    def record(self, position, error):
+        index, _ = self.__locate(position)
+        self.sums[index] += error
+        self.counts[index] += 1
+
+    def clear_recording(self):
+        self.sums = [0.0] * len(self.values)
+        self.counts = [0] * len(self.values)
+
+    @property
+    def coverage(self):
+        """ Fraction of the table points with enough recorded samples to learn from """
+        return sum(1 for count in self.counts if count >= MIN_SAMPLES_PER_BIN) / len(self.counts)
+
+    def learn(self, gain=DEFAULT_LEARNING_GAIN):
+        """ Corrects the table with the periodic part of the recorded errors (position minus target) """
+        if self.coverage < 1:
+            raise ValueError('The recording covers {:.0%} of the period, record at least a full period'.format(
+                self.coverage))
+
+        errors = [total / count for total, count in zip(self.sums, self.counts)]
+        mean = sum(errors) / len(errors)
+        self.values = [value - gain * (error - mean) for value, error in zip(self.values, errors)]
+        self.__precompute()
+        self.clear_recording()
+
+    def to_dict(self):
+        return {
+            'period': self.period,
+            'values': list(self.values),
+            'backlash': self.backlash,
+            'enabled': self.enabled,
+            'recording': self.recording,
+            'coverage': self.coverage,
+        }
+
+    @classmethod
+    def from_dict(cls, data, period=None):
+        return cls(
+            data.get('period') or period,
+            values=data.get('values'),
+            bins=data.get('bins', DEFAULT_BINS),
+            backlash=data.get('backlash', 0),
+            enabled=data.get('enabled', True),
+        )
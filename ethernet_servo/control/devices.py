@@ -1,16 +1,28 @@
+import threading
+
 import attr
 
-from . import control
+from . import control, scheduling
 
 
 # Default polling time in milliseconds
 DEFAULT_INTERVAL = 50
+# Default seconds a device has to be calm before it is polled less often
+DEFAULT_INTERVAL_HOLD = 2.0
 # Default max speed in steps per second
 DEFAULT_MAX_SPEED = 20000
 
 __devices = []
 __devices_by_id = {}
 
+# Bumped every time the state of any device changes
+__changes = {
+    'version': 0,
+    'condition': threading.Condition(),
+    # Last ServoController.digest() of every device, by id
+    'digests': {},
+}
+
 
 def get(id=None):
     if id is None:
@@ -44,12 +56,32 @@ class Device(object):
     Kp = attr.ib(default=1.8)
     Ki = attr.ib(default=1)
     Kd = attr.ib(default=1)
+    # Gain applied to the known setpoint speed (tracking, trajectories, run_speed) added to the PID output. 0 disables it.
+    feedforward = attr.ib(default=1.0)
+    # Gains for each motion regime that differ from the ones above, see control.scheduling, and seconds after a
+    # goto the settling gains are used
+    gain_schedule = attr.ib(default=None)
+    settle_time = attr.ib(default=scheduling.DEFAULT_SETTLE_TIME)
+    # Periodic error and backlash correction table, see control.correction
+    correction = attr.ib(default=None)
     offset = attr.ib(default=0)
     max_speed = attr.ib(default=DEFAULT_MAX_SPEED)
+    # Goto speed in degrees per second and acceleration in degrees per second squared, derived from max_speed if not given
+    max_slew_speed = attr.ib(default=None)
+    max_acceleration = attr.ib(default=None)
     interval = attr.ib(default=DEFAULT_INTERVAL)
+    # Polling intervals in milliseconds while slewing and while idle, and seconds to wait before slowing down
+    min_interval = attr.ib(default=None)
+    max_interval = attr.ib(default=None)
+    interval_hold = attr.ib(default=DEFAULT_INTERVAL_HOLD)
     supports_hour_angle = attr.ib(default=False)
     can_track = attr.ib(default=False)
-    serial_port = attr.ib(default=None, init=False)
+    # Serial port of the step/direction board driving this axis and its speed, defaults to the --serial* options.
+    # Devices on the same port share it.
+    serial_port = attr.ib(default=None)
+    serial_baudrate = attr.ib(default=None)
+    # Gateway worker running this device, see ethernet_servo.gateway
+    worker = attr.ib(default=None)
     initial_state = attr.ib(default=None)
     controller = attr.ib(init=False, default=attr.Factory(control.ServoController, takes_self=True))
 
@@ -58,3 +90,35 @@ def create(**kwargs):
     device = Device(**kwargs)
     __devices.append(device)
     return device
+
+
+def changed(device=None):
+    """ Signals that the state of device (or of several devices) changed, waking up wait_for_change().
+
+    With a device it only counts if its digest differs from the last one, so idle devices polled over and over
+    keep the version, and etags, still.
+    """
+    if device is not None:
+        digest = device.controller.digest()
+        if __changes['digests'].get(device.id) == digest:
+            return
+        __changes['digests'][device.id] = digest
+
+    condition = __changes['condition']
+    with condition:
+        __changes['version'] += 1
+        condition.notify_all()
+
+
+def version():
+    return __changes['version']
+
+
+def wait_for_change(last_version, timeout=None):
+    """ Blocks until the state version is not last_version anymore or timeout seconds pass.
+    Returns the current version.
+    """
+    condition = __changes['condition']
+    with condition:
+        condition.wait_for(lambda: __changes['version'] != last_version, timeout)
+        return __changes['version']
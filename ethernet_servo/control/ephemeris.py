@@ -0,0 +1,257 @@
+import os
+import csv
+import time
+import logging
+import datetime
+
+import numpy as np
+
+from ethernet_servo.control import units
+
+
+log = logging.getLogger('ethernet-encoder-servo')
+
+# Seconds between the precomputed positions a target is interpolated from
+CACHE_STEP = 1.0
+# Seconds of positions computed ahead, a refill starts when less than half of them are left
+CACHE_WINDOW = 600.0
+
+COORDINATES = ['ra', 'dec']
+
+__ephemerides = {}
+
+# How refills are run, see set_spawn()
+__refill = {
+    'spawn': None,
+}
+
+
+def get(name=None):
+    if name is None:
+        return list(__ephemerides.values())
+    return __ephemerides.get(name)
+
+
+def add(ephemeris):
+    __ephemerides[ephemeris.name] = ephemeris
+    return ephemeris
+
+
+def remove(name):
+    return __ephemerides.pop(name, None)
+
+
+def set_spawn(spawn):
+    """ Runs cache refills with spawn(function) instead of in the control loop, ie. in a thread pool """
+    __refill['spawn'] = spawn
+
+
+def _spawn_refill(refill):
+    spawn = __refill['spawn']
+    if spawn is None:
+        return refill()
+    return spawn(refill)
+
+
+def parse_time(value):
+    """ Unix timestamp from a number or an ISO 8601 date, UTC unless it says otherwise """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    value = value.strip().replace('Z', '+00:00')
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+
+def _unwrap24(hours):
+    """ Removes the jumps at 0h from a sequence of right ascensions """
+    if len(hours) < 2:
+        return hours
+    steps = (np.diff(hours) + 12.0) % 24.0 - 12.0
+    return hours[0] + np.concatenate(([0.0], np.cumsum(steps)))
+
+
+class Ephemeris:
+    """ Positions of a moving target at known times, ie. a planet, the Moon or a comet.
+
+    times are unix timestamps, ra is in hours and dec in degrees. Positions in between are interpolated
+    linearly, so rows should be close enough for that (a few minutes apart for the Moon).
+    """
+    def __init__(self, name, times, ra, dec):
+        times = np.asarray([parse_time(t) if isinstance(t, str) else t for t in times], dtype=float)
+        if times.size < 2:
+            raise ValueError('An ephemeris needs at least two rows')
+
+        order = np.argsort(times)
+        self.name = name
+        self.times = times[order]
+        self.ra = _unwrap24(np.asarray(ra, dtype=float)[order])
+        self.dec = np.asarray(dec, dtype=float)[order]
+
+    @classmethod
+    def from_rows(cls, name, rows):
+        """ Builds it from dicts with time, ra and dec """
+        try:
+            return cls(name, [row['time'] for row in rows], [row['ra'] for row in rows], [row['dec'] for row in rows])
+        except (KeyError, TypeError) as e:
+            raise ValueError('Invalid ephemeris rows: {}'.format(e))
+
+    @classmethod
+    def load(cls, path, name=None):
+        """ Reads a CSV file with time, ra and dec columns, lines starting with # are ignored """
+        if name is None:
+            name = os.path.splitext(os.path.basename(path))[0]
+
+        with open(path, 'r', newline='') as f:
+            lines = (line for line in f if line.strip() and not line.startswith('#'))
+            rows = [{k.strip(): v for k, v in row.items()} for row in csv.DictReader(lines)]
+
+        return cls.from_rows(name, rows)
+
+    @property
+    def start(self):
+        return float(self.times[0])
+
+    @property
+    def end(self):
+        return float(self.times[-1])
+
+    def covers(self, timestamp):
+        return self.start <= timestamp <= self.end
+
+    def positions(self, timestamps):
+        """ (ra, dec) arrays at timestamps, ra is not wrapped to 24h """
+        return np.interp(timestamps, self.times, self.ra), np.interp(timestamps, self.times, self.dec)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'start': self.start,
+            'end': self.end,
+            'rows': int(self.times.size),
+        }
+
+
+class EphemerisTarget:
+    """ Follows an ephemeris on one axis, coordinate is 'ra' (hour angle axes) or 'dec'.
+
+    It stands in for an AstronomicalPosition as a controller tracking target. Positions are precomputed
+    every CACHE_STEP seconds for the next CACHE_WINDOW seconds so the control loop only interpolates
+    between two of them, sidereal time included. The cache is refilled before it runs out.
+    Interpolation stops at the ends of the ephemeris, covers() tells whether it still has positions.
+    """
+    def __init__(self, ephemeris, coordinate='ra', longitude=None, step=CACHE_STEP, window=CACHE_WINDOW):
+        if coordinate not in COORDINATES:
+            raise ValueError('Unknown coordinate: {}'.format(coordinate))
+        if not ephemeris.covers(time.time()):
+            raise ValueError("Ephemeris '{}' does not cover the current time".format(ephemeris.name))
+
+        self.ephemeris = ephemeris
+        self.coordinate = coordinate
+        self.longitude = longitude
+        self.step = step
+        self.window = window
+        self.refilling = False
+        self.cache = self.__fill(time.time())
+
+    def __fill(self, start):
+        times = start + self.step * np.arange(int(self.window / self.step) + 2)
+        ra, dec = self.ephemeris.positions(times)
+        # Unwrapped so interpolation never goes across 0h
+        lst = units.LST(self.longitude, timestamp=start) + (times - start) * units.SIDEREAL_RATIO / 3600.0
+        return (start, ra.tolist(), lst.tolist(), dec.tolist())
+
+    def __refill(self, start):
+        def refill():
+            try:
+                self.cache = self.__fill(start)
+            finally:
+                self.refilling = False
+
+        self.refilling = True
+        _spawn_refill(refill)
+
+    def __interpolate(self, timestamp=None):
+        """ Returns (index, fraction) of timestamp in the cache and the cache itself """
+        if timestamp is None:
+            timestamp = time.time()
+
+        cache = self.cache
+        start, ra = cache[0], cache[1]
+        offset = (timestamp - start) / self.step
+        index = min(max(int(offset), 0), len(ra) - 2)
+
+        if not self.refilling and (offset > len(ra) / 2 or offset < 0):
+            self.__refill(timestamp)
+
+        return index, offset - index, cache
+
+    def __value(self, values, index, fraction):
+        return values[index] + fraction * (values[index + 1] - values[index])
+
+    def ra(self, timestamp=None):
+        """ Right ascension in hours """
+        index, fraction, cache = self.__interpolate(timestamp)
+        return units.range24(self.__value(cache[1], index, fraction))
+
+    def dec(self, timestamp=None):
+        """ Declination in degrees """
+        index, fraction, cache = self.__interpolate(timestamp)
+        return self.__value(cache[3], index, fraction)
+
+    def to_degrees_and_rate(self, timestamp=None):
+        """ Axis angle in degrees and its rate in degrees per second, like AstronomicalPosition """
+        index, fraction, cache = self.__interpolate(timestamp)
+        _, ra, lst, dec = cache
+
+        if self.coordinate == 'dec':
+            return self.__value(dec, index, fraction), (dec[index + 1] - dec[index]) / self.step
+
+        # Same as units.ra_to_deg_rate() but with interpolated right ascension and sidereal time
+        hour_angle = units.range24(self.__value(ra, index, fraction)) - units.range24(self.__value(lst, index, fraction))
+        rate = ((ra[index + 1] - ra[index]) - (lst[index + 1] - lst[index])) / self.step
+        degrees = hour_angle * 15.0
+        return units.rangeDec(degrees), 15.0 * rate * units.rangeDec_slope(degrees)
+
+    def to_degrees(self):
+        return self.to_degrees_and_rate()[0]
+
+    def covers(self, timestamp=None):
+        """ Whether the ephemeris has positions for timestamp, now if not given """
+        return self.ephemeris.covers(time.time() if timestamp is None else timestamp)
+
+    def position(self):
+        """ The current right ascension as a fixed value """
+        return units.AstronomicalPosition.from_decimal(self.ra(), self.longitude)
+
+    @property
+    def hours(self):
+        return self.position().hours
+
+    @property
+    def minutes(self):
+        return self.position().minutes
+
+    @property
+    def seconds(self):
+        return self.position().seconds
+
+    def __add__(self, other):
+        return self.position() + other
+
+    def __sub__(self, other):
+        return self.position() - other
+
+    def to_dict(self):
+        position = self.position().to_dict()
+        position.update({
+            'dec': self.dec(),
+            'ephemeris': self.ephemeris.name,
+            'coordinate': self.coordinate,
+            'covered': self.covers(),
+        })
+        return position
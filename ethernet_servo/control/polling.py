@@ -0,0 +1,49 @@
+# Polling modes from the fastest to the slowest
+MODES = ['fast', 'normal', 'idle']
+
+# Idle polling interval as a multiple of the normal one when max_interval is not configured
+DEFAULT_IDLE_FACTOR = 5
+# Seconds a slower mode has to be wanted before switching to it
+DEFAULT_HOLD = 2.0
+
+
+class PollingPolicy:
+    """ How often to poll an encoder, depending on what its axis is doing.
+
+    Intervals are in milliseconds: min_interval while slewing or settling, interval while tracking and
+    max_interval when idle. Faster modes are taken right away, slower ones only after being wanted for
+    hold seconds and one step at a time, so short pauses do not make the polling rate flap.
+    """
+    def __init__(self, interval, min_interval=None, max_interval=None, hold=DEFAULT_HOLD):
+        self.intervals = {
+            'fast': min_interval or interval,
+            'normal': interval,
+            'idle': max_interval or interval * DEFAULT_IDLE_FACTOR,
+        }
+        self.hold = hold
+        self.mode = 'normal'
+        self.calm = 0
+
+    @property
+    def interval(self):
+        return self.intervals[self.mode]
+
+    def process(self, wanted, dt):
+        """ Moves towards the wanted mode after dt seconds in the current one, returns the interval to use """
+        current = MODES.index(self.mode)
+        if MODES.index(wanted) <= current:
+            self.mode = wanted
+            self.calm = 0
+        else:
+            self.calm += dt
+            if self.calm >= self.hold:
+                self.mode = MODES[current + 1]
+                self.calm = 0
+
+        return self.interval
+
+    def to_dict(self):
+        return {
+            'mode': self.mode,
+            'interval': self.interval,
+        }
@@ -0,0 +1,63 @@
+# Motion regimes, in the order they take precedence
+REGIMES = ['slewing', 'settling', 'free_running', 'tracking', 'holding']
+
+# Parameters a regime can change: PID gains, derivative filtering and the deadband in encoder counts
+GAINS = ['Kp', 'Ki', 'Kd', 'derivative_filtering', 'deadband']
+
+# Seconds after a goto during which the settling gains are used
+DEFAULT_SETTLE_TIME = 2.0
+
+
+class GainSchedule:
+    """ PID parameters for each motion regime.
+
+    table maps regimes to the parameters that differ from the base ones, so an empty table keeps a single
+    set of gains. Regimes are picked with regime(): slewing while a goto trajectory runs, settling for
+    settle_time seconds after it ends, then free running, tracking or holding.
+    """
+    def __init__(self, table=None, settle_time=DEFAULT_SETTLE_TIME):
+        self.table = {}
+        self.settle_time = settle_time
+        # When the last goto trajectory was seen running
+        self.slewed_at = None
+        self.update(table or {})
+
+    def update(self, table):
+        """ Replaces the parameters of the regimes in table, an empty or null entry clears a regime """
+        for regime, gains in table.items():
+            if regime not in REGIMES:
+                raise ValueError('Unknown regime: {}'.format(regime))
+            gains = gains or {}
+            unknown = set(gains) - set(GAINS)
+            if unknown:
+                raise ValueError('Unknown gains for {0}: {1}'.format(regime, ', '.join(sorted(unknown))))
+            self.table[regime] = {name: float(value) for name, value in gains.items() if value is not None}
+
+    def regime(self, slewing, free_running, tracking, now):
+        """ The regime to use at now (a datetime) in the current conditions.
+
+        Settling is measured in elapsed time, so it also ends while the axis is idle and not updated.
+        """
+        if slewing:
+            self.slewed_at = now
+            return 'slewing'
+
+        if self.slewed_at is not None:
+            if (now - self.slewed_at).total_seconds() < self.settle_time:
+                return 'settling'
+            self.slewed_at = None
+
+        if free_running:
+            return 'free_running'
+        if tracking:
+            return 'tracking'
+        return 'holding'
+
+    def gains(self, regime, base):
+        """ Parameters to use in regime, base ones for those the table does not change """
+        gains = dict(base)
+        gains.update(self.table.get(regime, {}))
+        return gains
+
+    def to_dict(self):
+        return {regime: dict(gains) for regime, gains in self.table.items() if gains}
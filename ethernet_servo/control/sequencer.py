@@ -0,0 +1,318 @@
+import time
+import logging
+import threading
+import itertools
+
+from ethernet_servo.control import commands
+
+
+log = logging.getLogger('ethernet-encoder-servo')
+
+# Distance to the target in arcseconds, seconds it has to stay within it and seconds to wait for it by default
+DEFAULT_SETTLE_TOLERANCE = 10.0
+DEFAULT_SETTLE_STABLE = 1.0
+DEFAULT_SETTLE_TIMEOUT = 300.0
+
+# Finished sequences kept to be queried
+MAX_FINISHED = 50
+# Seconds between settle timeout checks, see expire()
+EXPIRE_INTERVAL = 1.0
+
+STATES = ['running', 'settling', 'dwelling', 'done', 'failed', 'aborted']
+FINISHED = ('done', 'failed', 'aborted')
+
+__sequences = {
+    'all': {},
+    'ids': itertools.count(1),
+    # Prepended to every id, see set_id_prefix()
+    'prefix': '',
+    # Called with every progress event, see set_listener()
+    'listener': None,
+}
+
+
+class Step:
+    """ Commands applied at once, then waiting for their devices to settle on target and dwelling there """
+    def __init__(self, step):
+        if not isinstance(step, dict):
+            raise ValueError('Steps must be objects, got {!r}'.format(step))
+
+        self.commands = step.get('commands', [])
+        if not isinstance(self.commands, list):
+            raise ValueError('Step commands must be a list')
+        # Fails now if any command is not valid, they are parsed again when the step starts
+        self.devices = []
+        for device, _ in (commands.parse(command) for command in self.commands):
+            if all(device is not other for other in self.devices):
+                self.devices.append(device)
+
+        settle = step.get('settle', True)
+        if isinstance(settle, bool) or settle is None:
+            self.settle = bool(settle)
+            settle = {}
+        elif isinstance(settle, dict):
+            self.settle = True
+        else:
+            raise ValueError('settle must be true, false or an object, got {!r}'.format(settle))
+        try:
+            self.tolerance = float(settle.get('tolerance', DEFAULT_SETTLE_TOLERANCE))
+            self.stable = float(settle.get('stable', DEFAULT_SETTLE_STABLE))
+            self.timeout = float(settle.get('timeout', DEFAULT_SETTLE_TIMEOUT))
+            self.dwell = float(step.get('dwell', 0))
+        except (TypeError, ValueError) as e:
+            raise ValueError('Invalid step timing: {}'.format(e))
+        self.on_timeout = step.get('on_timeout', 'fail')
+        if self.on_timeout not in ('fail', 'continue'):
+            raise ValueError("on_timeout must be 'fail' or 'continue'")
+
+    def settled(self):
+        """ True if every device of the step is at its target, within tolerance """
+        for device in self.devices:
+            controller = device.controller
+            if controller.trajectory.active:
+                return False
+            if abs(controller.position - controller.target_raw) > self.tolerance * controller.ANGLE_TO_RAW / 3600.0:
+                return False
+        return True
+
+    def to_dict(self):
+        return {
+            'commands': self.commands,
+            'devices': [device.id for device in self.devices],
+            'settle': {'tolerance': self.tolerance, 'stable': self.stable, 'timeout': self.timeout} if self.settle else None,
+            'dwell': self.dwell,
+            'on_timeout': self.on_timeout,
+        }
+
+
+class Sequence:
+    """ Moves advanced by the control loop: each step starts when the previous one settled and dwelled """
+    def __init__(self, steps, name=None):
+        if not isinstance(steps, list) or not steps:
+            raise ValueError('Expected a list of steps')
+
+        self.steps = [Step(step) for step in steps]
+        self.devices = []
+        for step in self.steps:
+            for device in step.devices:
+                if all(device is not other for other in self.devices):
+                    self.devices.append(device)
+        if not self.devices:
+            raise ValueError('A sequence needs at least one command, it is advanced by the control loop of its devices')
+
+        self.id = _next_id()
+        self.name = name or self.id
+
+        self.state = 'running'
+        self.index = -1
+        self.message = ''
+        self.started = time.monotonic()
+        self.since = self.started
+        self.stable_since = None
+        self.events = []
+        self.condition = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.state in FINISHED
+
+    @property
+    def current(self):
+        if 0 <= self.index < len(self.steps):
+            return self.steps[self.index]
+        return None
+
+    def __event(self, state, message=''):
+        self.state = state
+        self.message = message
+        event = {
+            'sequence': self.id,
+            'name': self.name,
+            'state': state,
+            'step': self.index,
+            'steps': len(self.steps),
+            'message': message,
+            'elapsed': time.monotonic() - self.started,
+        }
+        with self.condition:
+            self.events.append(event)
+            self.condition.notify_all()
+        _notify(event)
+
+    def __start_step(self, now):
+        self.index += 1
+        self.since = now
+        self.stable_since = None
+        step = self.current
+        if step is None:
+            self.__event('done')
+            return
+
+        try:
+            commands.apply_batch(step.commands)
+        except Exception as e:
+            # Any error fails the sequence, it must never be left in a state advance() does not handle
+            log.exception('Step %s of sequence %s failed', self.index, self.id)
+            self.__event('failed', str(e))
+            return
+        if self.finished:
+            # A halt in the step aborted the sequence
+            return
+
+        self.__event('settling' if step.settle and step.devices else 'dwelling')
+
+    def advance(self, now=None):
+        """ Moves on to the next step when the current one is done, called on every control cycle """
+        if now is None:
+            now = time.monotonic()
+
+        # Several steps may complete in one cycle, ie: ones without commands nor dwell
+        while not self.finished:
+            step = self.current
+            if step is None:
+                self.__start_step(now)
+                continue
+
+            if self.state == 'settling':
+                if step.settled():
+                    if self.stable_since is None:
+                        self.stable_since = now
+                    if now - self.stable_since < step.stable:
+                        return
+                    self.since = now
+                    self.__event('dwelling')
+                    continue
+
+                self.stable_since = None
+                if now - self.since > step.timeout:
+                    self.__settle_timeout(step, now)
+                    continue
+                return
+
+            if self.state == 'dwelling':
+                if now - self.since < step.dwell:
+                    return
+                self.__start_step(now)
+                continue
+
+            return
+
+    def __settle_timeout(self, step, now):
+        if step.on_timeout == 'fail':
+            self.__event('failed', 'Step {} did not settle in {:.0f}s'.format(self.index, step.timeout))
+            return
+        self.since = now
+        self.__event('dwelling', 'did not settle, continuing')
+
+    def expire(self, now=None):
+        """ Applies the settle timeout of the current step, advance() only runs when its devices are polled """
+        if now is None:
+            now = time.monotonic()
+
+        step = self.current
+        if self.state == 'settling' and self.stable_since is None and now - self.since > step.timeout:
+            self.__settle_timeout(step, now)
+
+    def abort(self, message='aborted'):
+        if not self.finished:
+            self.__event('aborted', message)
+
+    def wait_for_event(self, seen, timeout=None):
+        """ Blocks until there are more than seen events or timeout seconds pass, returns the new ones """
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.events) > seen or self.finished, timeout)
+            return self.events[seen:]
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'state': self.state,
+            'step': self.index,
+            'steps': [step.to_dict() for step in self.steps],
+            'devices': [device.id for device in self.devices],
+            'message': self.message,
+            'elapsed': time.monotonic() - self.started,
+        }
+
+
+def _next_id():
+    return '{0}{1}'.format(__sequences['prefix'], next(__sequences['ids']))
+
+
+def set_id_prefix(prefix):
+    """ Prepends prefix to the ids of new sequences, so several servers behind a gateway do not reuse them """
+    __sequences['prefix'] = prefix or ''
+
+
+def _notify(event):
+    listener = __sequences['listener']
+    if listener is not None:
+        try:
+            listener(event)
+        except Exception as e:
+            log.error('Could not send sequence event: %s', e)
+
+
+def set_listener(listener):
+    """ Calls listener(event) with every sequence progress event """
+    __sequences['listener'] = listener
+
+
+def get(sequence_id=None):
+    if sequence_id is None:
+        return list(__sequences['all'].values())
+    return __sequences['all'].get(sequence_id)
+
+
+def running(device):
+    """ The unfinished sequence moving device, if any """
+    for sequence in __sequences['all'].values():
+        if not sequence.finished and any(device is other for other in sequence.devices):
+            return sequence
+    return None
+
+
+def start(steps, name=None):
+    """ Validates and starts a sequence, devices can only be moved by one sequence at a time """
+    sequence = Sequence(steps, name)
+    for device in sequence.devices:
+        other = running(device)
+        if other is not None:
+            raise ValueError("Device '{0}' is already moved by sequence {1}".format(device.id, other.id))
+
+    # Only registered once its first step started, the control loop never sees a sequence that could not
+    sequence.advance()
+    if sequence.state == 'failed':
+        raise ValueError(sequence.message)
+
+    all_sequences = __sequences['all']
+    finished = [key for key, other in all_sequences.items() if other.finished]
+    for key in finished[:max(0, len(finished) - MAX_FINISHED + 1)]:
+        del all_sequences[key]
+
+    all_sequences[sequence.id] = sequence
+    return sequence
+
+
+def abort(device, message='aborted'):
+    """ Stops the sequence moving device, ie: when it is halted """
+    sequence = running(device)
+    if sequence is not None:
+        sequence.abort(message)
+
+
+def expire(now=None):
+    """ Applies the settle timeouts of every running sequence, called from a timer so they still fire while the
+    encoders of their devices do not answer
+    """
+    for sequence in list(__sequences['all'].values()):
+        if not sequence.finished:
+            sequence.expire(now)
+
+
+def process(device, now=None):
+    """ Advances the sequence moving device, called from its control loop """
+    sequence = running(device)
+    if sequence is not None:
+        sequence.advance(now)
@@ -0,0 +1,75 @@
+import time
+import datetime
+import random
+from collections import deque
+
+from ethernet_servo.control.control import COUNTS_PER_REVOLUTION, saturate
+
+
+class SimulatedPlant:
+    """ A stepper motor with an absolute encoder on its shaft.
+
+    Stands in for both the ethernet encoder and the step/direction interface of a device: assign it as
+    the device serial_interface and feed encoder_value() to the controller. Commands take effect after
+    latency seconds and the encoder reading gets gaussian noise of the given deviation (in counts).
+    """
+    def __init__(self, device, position=0, latency=0.01, noise=0):
+        self.device = device
+        self.position = float(position)
+        self.latency = latency
+        self.noise = noise
+        self.frequency = 0
+        self.time = 0
+        self.pending = deque()
+
+    def update_stepper_frequency(self, freq, device, on_written=None):
+        self.pending.append((self.time + self.latency, saturate(freq, device.max_speed)))
+        if on_written is not None:
+            on_written(time.monotonic())
+
+    def advance(self, dt):
+        """ Moves the simulated motor dt seconds forward """
+        counts_per_step = 1.0 * COUNTS_PER_REVOLUTION / self.device.steps
+        end = self.time + dt
+
+        while self.time < end:
+            if self.pending and self.pending[0][0] <= self.time:
+                self.frequency = self.pending.popleft()[1]
+                continue
+
+            next_time = end
+            if self.pending and self.pending[0][0] < end:
+                next_time = self.pending[0][0]
+
+            self.position += self.frequency * counts_per_step * (next_time - self.time)
+            self.time = next_time
+
+    def encoder_value(self):
+        position = self.position
+        if self.noise:
+            position += random.gauss(0, self.noise)
+        return int(round(position)) % COUNTS_PER_REVOLUTION
+
+
+def run(controller, plant, duration, dt=None, start=None, callback=None):
+    """ Runs a controller against a simulated plant for duration seconds, as fast as possible.
+
+    The controller gets a simulated clock starting at start (defaults to where the last run ended, or now),
+    callback(now) is called after every control cycle. Returns the simulated time at the end.
+    """
+    if dt is None:
+        dt = controller.device.interval / 1000.0
+
+    now = start
+    if now is None:
+        now = controller._state['old_timestamp'] or datetime.datetime.now()
+
+    step = datetime.timedelta(seconds=dt)
+    for _ in range(int(round(duration / dt))):
+        plant.advance(dt)
+        now += step
+        controller.update(plant.encoder_value(), now=now)
+        if callback is not None:
+            callback(now)
+
+    return now
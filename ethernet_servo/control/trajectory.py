@@ -0,0 +1,62 @@
+import math
+
+
+class TrapezoidalProfile:
+    """ Velocity and acceleration limited motion towards a goal.
+
+    Positions are in raw encoder counts, velocities in counts per second and accelerations in counts per
+    second squared. The profile is planned online one control cycle at a time, so the goal can keep moving
+    (i.e. while tracking) without planning again.
+    """
+    def __init__(self, max_velocity, max_acceleration):
+        self.max_velocity = max_velocity
+        self.max_acceleration = max_acceleration
+        self.position = 0
+        self.velocity = 0
+        self.goal = 0
+        self.active = False
+
+    def start(self, position, goal, velocity=0):
+        self.position = position
+        self.velocity = velocity
+        self.goal = goal
+        self.active = True
+
+    def stop(self):
+        self.velocity = 0
+        self.active = False
+
+    def step(self, dt):
+        """ Advances the profile dt seconds and returns the new setpoint """
+        if not self.active:
+            return self.goal
+
+        max_acceleration = self.max_acceleration
+        max_change = max_acceleration * dt
+
+        error = self.goal - self.position
+        direction = 1 if error >= 0 else -1
+
+        # Fastest speed we can still brake from before reaching the goal, one cycle early as we move in steps
+        braking_velocity = max(0.0, math.sqrt(2.0 * max_acceleration * abs(error)) - max_change)
+        velocity_target = direction * min(self.max_velocity, braking_velocity)
+
+        delta = velocity_target - self.velocity
+        if delta > max_change:
+            delta = max_change
+        elif delta < -max_change:
+            delta = -max_change
+        velocity = self.velocity + delta
+
+        position = self.position + 0.5 * (self.velocity + velocity) * dt
+
+        # Only snap to the goal when slow enough, otherwise the goal moved behind us and we have to brake
+        overshoot = (self.goal - position) * direction < 0 and abs(velocity) <= max_change
+        if overshoot or abs(error) <= max_change * dt:
+            self.position = self.goal
+            self.stop()
+            return self.goal
+
+        self.position = position
+        self.velocity = velocity
+        return position
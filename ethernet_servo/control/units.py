@@ -1,22 +1,54 @@
 import math
-import attr
+import time
+import logging
+import functools
 
-from astropy.time import Time
 
+log = logging.getLogger('ethernet-encoder-servo')
 
 SITE_LONGITUDE = -58.381592
 
+# Unit values remembered by from_decimal()
+UNIT_CACHE_SIZE = 1024
+
+# Sidereal days are shorter than solar days by this factor
+SIDEREAL_RATIO = 1.00273790935
+# Hour angle of a fixed RA grows by this many degrees per second
+SIDEREAL_RATE = 15.0 * SIDEREAL_RATIO / 3600.0
+
+# Earth orientation data settings, see configure()
+__iers = {
+    'auto_download': False,
+    'table_path': None,
+}
+
+# astropy is heavy to import and its first sidereal_time() call takes a while, so it is loaded on demand
+# (or in the background, see load_astropy_async()) and LST() falls back to an approximation meanwhile.
+__astropy = {
+    'Time': None,
+    'loading': False,
+    # Why loading failed, LST() stays on the approximation instead of trying again on every call
+    'error': None,
+}
+
+# Seconds a sidereal time anchor is extrapolated from, and how often the server computes a new one
+SIDEREAL_ANCHOR_SPAN = 3600.0
+SIDEREAL_ANCHOR_REFRESH = 60.0
+
+# (unix timestamp, apparent sidereal time in hours at Greenwich) computed by astropy off the control loop,
+# see refresh_sidereal_anchor(). LST() extrapolates it, which is plain arithmetic.
+__sidereal = {
+    'anchor': None,
+    # Runs refreshes of a stale anchor off the caller, see set_spawn()
+    'spawn': None,
+    'refreshing': False,
+}
+
 # From libindi/libs/indicom.c
 
 
 def range24(v):
-    res = v
-    while res < 0:
-        res += 24.0
-    while res > 24:
-        res -= 24.0
-
-    return res
+    return v % 24.0
 
 
 def rangeDec(decdegrees):
@@ -30,14 +62,166 @@ def rangeDec(decdegrees):
     return decdegrees
 
 
-def LST(longitude=None):
+def rangeDec_slope(decdegrees):
+    """ Derivative of rangeDec(), -1 where it folds the angle back """
+    if ((decdegrees >= 90.0) and (decdegrees < 270.0)):
+        return -1.0
+    return 1.0
+
+
+def configure(iers_table_path=None, iers_auto_download=False):
+    """ Earth orientation data to use once astropy is loaded.
+
+    By default only the tables bundled with astropy are used so we never hang trying to download them
+    on an offline network, iers_table_path points to a local IERS-A file (finals2000A.all) instead.
+    """
+    __iers['table_path'] = iers_table_path
+    __iers['auto_download'] = iers_auto_download
+
+
+def __configure_iers():
+    from astropy.utils import iers
+
+    iers.conf.auto_download = __iers['auto_download']
+    if not __iers['auto_download']:
+        iers.conf.auto_max_age = None
+        # Predictions for dates past the bundled tables are still far better than our needs
+        iers.conf.iers_degraded_accuracy = 'warn'
+        try:
+            from astropy.utils import data
+            data.conf.allow_internet = False
+        except AttributeError:
+            pass
+
+    if __iers['table_path']:
+        iers.earth_orientation_table.set(iers.IERS_A.open(__iers['table_path']))
+
+
+def load_astropy():
+    """ Imports astropy and warms up sidereal time computations, this takes a few seconds """
+    if __astropy['Time'] is not None:
+        return __astropy['Time']
+
+    __astropy['loading'] = True
+    try:
+        from astropy.time import Time
+        __configure_iers()
+        # First call to sidereal_time() takes a while to initialize. Time is published once there is an anchor,
+        # so LST() keeps approximating meanwhile instead of calling astropy itself
+        __sidereal['anchor'] = __compute_anchor(Time)
+        __astropy['Time'] = Time
+        __astropy['error'] = None
+    except Exception as e:
+        __astropy['error'] = e
+        raise
+    finally:
+        __astropy['loading'] = False
+
+    log.debug('astropy loaded')
+    return __astropy['Time']
+
+
+def load_astropy_async(spawn):
+    """ Loads astropy using spawn(function), LST() is approximated until it is done """
+    __astropy['loading'] = True
+    return spawn(load_astropy)
+
+
+def astropy_ready():
+    return __astropy['Time'] is not None
+
+
+def astropy_error():
+    """ The exception that kept astropy from loading, None if it did not fail """
+    return __astropy['error']
+
+
+def approximate_LST(longitude=None, timestamp=None):
+    """ Mean local sidereal time in hours, good to a couple of seconds, without astropy """
     if longitude is None:
         longitude = SITE_LONGITUDE
-    now = Time.now()
-    lst = now.sidereal_time('apparent', longitude=longitude).to_value()
+    if timestamp is None:
+        timestamp = time.time()
+
+    days = timestamp / 86400.0 + 2440587.5 - 2451545.0
+    centuries = days / 36525.0
+    gmst = 280.46061837 + 360.98564736629 * days + 0.000387933 * centuries**2 - centuries**3 / 38710000.0
+    return ((gmst + longitude) % 360.0) / 15.0
+
+
+def __compute_anchor(Time):
+    timestamp = time.time()
+    return (timestamp, Time(timestamp, format='unix').sidereal_time('apparent', longitude=0).to_value())
+
+
+def refresh_sidereal_anchor():
+    """ Computes a new sidereal time anchor with astropy, slow enough that the server runs it in a native thread """
+    Time = __astropy['Time'] or load_astropy()
+    __sidereal['anchor'] = __compute_anchor(Time)
+    return __sidereal['anchor']
+
+
+def __refresh_sidereal_anchor_async():
+    if __sidereal['refreshing']:
+        return
+
+    def refresh():
+        try:
+            refresh_sidereal_anchor()
+        except Exception as e:
+            log.error('Could not compute sidereal time: %s', e)
+        finally:
+            __sidereal['refreshing'] = False
+
+    __sidereal['refreshing'] = True
+    __sidereal['spawn'](refresh)
+
+
+def set_spawn(spawn):
+    """ Refreshes stale sidereal time anchors with spawn(function) instead of in the LST() caller """
+    __sidereal['spawn'] = spawn
+
+
+def sidereal_anchor():
+    return __sidereal['anchor']
+
+
+def __extrapolate(anchor, longitude, timestamp):
+    return range24(anchor[1] + (timestamp - anchor[0]) * SIDEREAL_RATIO / 3600.0 + longitude / 15.0)
+
+
+def LST(longitude=None, timestamp=None):
+    """ Apparent local sidereal time in hours, now or at a unix timestamp.
+
+    Within SIDEREAL_ANCHOR_SPAN seconds of the last anchor it is extrapolated from it. A stale anchor is still
+    extrapolated while a new one is computed with the set_spawn() function, astropy is only called here without
+    one or for timestamps far from now.
+    """
+    if longitude is None:
+        longitude = SITE_LONGITUDE
+    if timestamp is None:
+        timestamp = time.time()
+
+    anchor = __sidereal['anchor']
+    if anchor is not None and abs(timestamp - anchor[0]) <= SIDEREAL_ANCHOR_SPAN:
+        return __extrapolate(anchor, longitude, timestamp)
+
+    Time = __astropy['Time']
+    if Time is None:
+        if __astropy['loading'] or __astropy['error'] is not None:
+            return approximate_LST(longitude, timestamp)
+        load_astropy()
+        return LST(longitude, timestamp)
+
+    if abs(timestamp - time.time()) <= SIDEREAL_ANCHOR_SPAN:
+        if __sidereal['spawn'] is not None and anchor is not None:
+            __refresh_sidereal_anchor_async()
+            return __extrapolate(anchor, longitude, timestamp)
+        refresh_sidereal_anchor()
+        return LST(longitude, timestamp)
+
+    lst = Time(timestamp, format='unix').sidereal_time('apparent', longitude=longitude).to_value()
     return range24(lst)
-# First call to sidereal_time() takes a while to initialize
-LST()   # noqa
 
 
 def deg_to_ra(deg, longitude=None):
@@ -53,6 +237,13 @@ def ra_to_deg(ra, longitude=None):
     return deg
 
 
+def ra_to_deg_rate(ra, longitude=None):
+    """ Like ra_to_deg() but also returns how fast that angle changes, in degrees per second """
+    ra -= LST(longitude=longitude)
+    deg = ra * 15.0
+    return rangeDec(deg), -SIDEREAL_RATE * rangeDec_slope(deg)
+
+
 def decimal_to_dms(angle):
     sign = 1.0
     if angle < 0:
@@ -72,50 +263,194 @@ def decimal_to_dms(angle):
     return (degrees, minutes, seconds)
 
 
-@attr.s
-class AnglePosition:
-    degrees = attr.ib(default=0)
-    minutes = attr.ib(default=0)
-    seconds = attr.ib(default=0)
+class _UnitValue:
+    """ Immutable value stored as a decimal number, its sexagesimal parts are computed on first use """
+    __slots__ = ('_decimal', '_parts')
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is immutable'.format(self.__class__.__name__))
+
+    @classmethod
+    def _from_decimal(cls, value):
+        instance = cls.__new__(cls)
+        object.__setattr__(instance, '_decimal', value)
+        object.__setattr__(instance, '_parts', None)
+        return instance
+
+    def _sexagesimal(self):
+        parts = self._parts
+        if parts is None:
+            parts = decimal_to_dms(self._decimal)
+            object.__setattr__(self, '_parts', parts)
+        return parts
 
     def to_decimal(self):
-        return self.degrees + self.minutes / 60.0 + self.seconds / 3600.0
+        return self._decimal
+
+    def __float__(self):
+        return float(self._decimal)
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash((self.__class__, self._key()))
+
+    def _key(self):
+        return self._decimal
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for cls in self.__class__.__mro__ for name in getattr(cls, '__slots__', ())}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+
+class AnglePosition(_UnitValue):
+    __slots__ = ()
+
+    def __init__(self, degrees=0, minutes=0, seconds=0):
+        object.__setattr__(self, '_decimal', degrees + minutes / 60.0 + seconds / 3600.0)
+        object.__setattr__(self, '_parts', None)
+
+    @property
+    def degrees(self):
+        return self._sexagesimal()[0]
+
+    @property
+    def minutes(self):
+        return self._sexagesimal()[1]
+
+    @property
+    def seconds(self):
+        return self._sexagesimal()[2]
 
     def to_dict(self):
+        degrees, minutes, seconds = self._sexagesimal()
         return {
-            'degrees': self.degrees,
-            'minutes': self.minutes,
-            'seconds': self.seconds
+            'degrees': degrees,
+            'minutes': minutes,
+            'seconds': seconds
         }
 
     @classmethod
     def from_decimal(cls, angle):
-        degrees, minutes, seconds = decimal_to_dms(angle)
-        return cls(degrees, minutes, seconds)
+        return _cached_angle(cls, angle)
+
+    def __add__(self, other):
+        return self.from_decimal(self._decimal + float(other))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return self.from_decimal(self._decimal - float(other))
+
+    def __neg__(self):
+        return self.from_decimal(-self._decimal)
+
+    def __repr__(self):
+        return 'AnglePosition(degrees={0}, minutes={1}, seconds={2})'.format(*self._sexagesimal())
 
 
-@attr.s
-class AstronomicalPosition:
-    hours = attr.ib(default=0)
-    minutes = attr.ib(default=0)
-    seconds = attr.ib(default=0)
-    longitude = attr.ib(default=None)
+class AstronomicalPosition(_UnitValue):
+    """ Right ascension in hours, converted to an angle using the local sidereal time at longitude """
+    __slots__ = ('longitude', )
+
+    def __init__(self, hours=0, minutes=0, seconds=0, longitude=None):
+        object.__setattr__(self, '_decimal', hours + minutes / 60.0 + seconds / 3600.0)
+        object.__setattr__(self, '_parts', None)
+        object.__setattr__(self, 'longitude', longitude)
 
     @classmethod
-    def from_degrees(cls, degrees, longitude=None):
-        hours, minutes, seconds = decimal_to_dms(deg_to_ra(degrees, longitude))
-        return cls(hours, minutes, seconds)
+    def from_decimal(cls, hours, longitude=None):
+        instance = cls._from_decimal(hours)
+        object.__setattr__(instance, 'longitude', longitude)
+        return instance
 
-    def to_decimal(self):
-        return self.hours + self.minutes / 60.0 + self.seconds / 3600.0
+    @classmethod
+    def from_degrees(cls, degrees, longitude=None, deferred=False):
+        """ The right ascension at an axis angle now. If deferred it is worked out when first read instead, so
+        building states that may never be serialized does not need the sidereal time.
+        """
+        if deferred:
+            return _DeferredAstronomicalPosition(degrees, longitude)
+        return cls.from_decimal(deg_to_ra(degrees, longitude), longitude)
+
+    @property
+    def hours(self):
+        return self._sexagesimal()[0]
+
+    @property
+    def minutes(self):
+        return self._sexagesimal()[1]
+
+    @property
+    def seconds(self):
+        return self._sexagesimal()[2]
+
+    def _key(self):
+        return (self._decimal, self.longitude)
 
     def to_degrees(self):
-        return ra_to_deg(self.to_decimal(), self.longitude)
+        return ra_to_deg(self._decimal, self.longitude)
+
+    def to_degrees_and_rate(self):
+        return ra_to_deg_rate(self._decimal, self.longitude)
 
     def to_dict(self):
+        hours, minutes, seconds = self._sexagesimal()
         return {
-            'hours':   self.hours,
-            'minutes': self.minutes,
-            'seconds': self.seconds,
+            'hours':   hours,
+            'minutes': minutes,
+            'seconds': seconds,
             'longitude': self.longitude
         }
+
+    def __add__(self, other):
+        return self.from_decimal(range24(self._decimal + float(other)), self.longitude)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return self.from_decimal(range24(self._decimal - float(other)), self.longitude)
+
+    def __repr__(self):
+        return 'AstronomicalPosition(hours={0}, minutes={1}, seconds={2}, longitude={3})'.format(
+            *(self._sexagesimal() + (self.longitude, )))
+
+
+class _DeferredAstronomicalPosition(AstronomicalPosition):
+    """ An AstronomicalPosition given by an axis angle, the right ascension is computed on first use """
+    __slots__ = ('_degrees', '_hours')
+
+    def __init__(self, degrees, longitude=None):
+        object.__setattr__(self, '_degrees', degrees)
+        object.__setattr__(self, '_hours', None)
+        object.__setattr__(self, '_parts', None)
+        object.__setattr__(self, 'longitude', longitude)
+
+    @property
+    def _decimal(self):
+        hours = self._hours
+        if hours is None:
+            hours = deg_to_ra(self._degrees, self.longitude)
+            object.__setattr__(self, '_hours', hours)
+        return hours
+
+    @classmethod
+    def from_decimal(cls, hours, longitude=None):
+        return AstronomicalPosition.from_decimal(hours, longitude)
+
+    def __reduce_ex__(self, protocol):
+        """ Copies and pickles are plain AstronomicalPositions resolved now, _decimal can not be set back """
+        return (AstronomicalPosition.from_decimal, (self._decimal, self.longitude))
+
+
+# Angles read over and over (parked axes, fixed targets, run speeds) are shared instead of created again. Right
+# ascensions are not cached, they change with the sidereal time on every cycle.
+@functools.lru_cache(maxsize=UNIT_CACHE_SIZE)
+def _cached_angle(cls, angle):
+    return cls._from_decimal(angle)
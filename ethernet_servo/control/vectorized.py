@@ -0,0 +1,65 @@
+""" Array versions of the conversions in units, for whole columns of positions at once.
+
+They take anything numpy.asarray() accepts and give the same results as their scalar counterparts.
+Conversions that depend on time evaluate the sidereal time once and extrapolate it to every timestamp.
+"""
+import time
+
+import numpy as np
+
+from ethernet_servo.control import units
+
+
+def range24(v):
+    return np.mod(v, 24.0)
+
+
+def rangeDec(decdegrees):
+    decdegrees = np.asarray(decdegrees, dtype=float)
+    return np.select(
+        [(decdegrees >= 270.0) & (decdegrees <= 360.0), (decdegrees >= 90.0) & (decdegrees < 270.0)],
+        [decdegrees - 360.0, 180.0 - decdegrees],
+        decdegrees
+    )
+
+
+def decimal_to_dms(angle):
+    """ Returns the (degrees, minutes, seconds) arrays of angle, all with its sign """
+    angle = np.asarray(angle, dtype=float)
+    sign = np.where(angle < 0, -1.0, 1.0)
+    angle = np.fabs(angle)
+
+    degrees = np.floor(angle)
+    minutes_float = (angle - degrees) * 60
+    minutes = np.floor(minutes_float)
+    seconds = (minutes_float - minutes) * 60
+
+    return (degrees * sign, minutes * sign, seconds * sign)
+
+
+def LST(timestamps=None, longitude=None):
+    """ Local sidereal time in hours at each unix timestamp (defaults to now).
+
+    Sidereal time is only computed at the first timestamp, the rest are extrapolated at the sidereal rate.
+    Nutation makes that drift from astropy's apparent sidereal time by up to about 12 milliseconds per day.
+    """
+    if timestamps is None:
+        timestamps = time.time()
+    timestamps = np.asarray(timestamps, dtype=float)
+    if timestamps.size == 0:
+        return timestamps.copy()
+
+    anchor = float(timestamps.flat[0])
+    lst = units.LST(longitude=longitude, timestamp=anchor)
+    return range24(lst + (timestamps - anchor) * units.SIDEREAL_RATIO / 3600.0)
+
+
+def deg_to_ra(deg, timestamps=None, longitude=None):
+    ra = np.asarray(deg, dtype=float) / 15.0
+    ra = ra + LST(timestamps, longitude=longitude)
+    return range24(ra)
+
+
+def ra_to_deg(ra, timestamps=None, longitude=None):
+    ra = np.asarray(ra, dtype=float) - LST(timestamps, longitude=longitude)
+    return rangeDec(ra * 15.0)
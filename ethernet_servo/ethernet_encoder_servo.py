@@ -6,6 +6,7 @@ import gevent.monkey
 gevent.monkey.patch_all() # noqa
 
 import sys
+import time
 import signal
 import atexit
 
@@ -17,15 +18,15 @@ from datetime import datetime
 
 import munch
 
-from flask import Flask, render_template, g
+from flask import Flask, render_template, g, request
 from flask.json import jsonify
 from flask_socketio import SocketIO
 
 from cpppo.server.enip.get_attribute import proxy_simple
 from cpppo.server.enip import poll
 
-from . import api
-from .control import devices, units, SerialPortInterface
+from . import api, telemetry, serialization, profiling, tracing
+from .control import devices, units, simulation, commands, ephemeris, sequencer, get_serial_interface, DEFAULT_SERIAL_PORT, DEFAULT_BAUDRATE
 
 log = logging.getLogger('ethernet-encoder-servo')
 
@@ -34,19 +35,57 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
 api.register(app)
 
-socketio = SocketIO(app, async_mode='gevent')
+# Telemetry frames are encoded once and spliced as they are into every Socket.IO packet
+socketio = SocketIO(app, async_mode='gevent', json=serialization)
 
 POSITION_PARAM = '@0x23/1/0x0a'
 VELOCITY_PARAM = '@0x23/1/0x18'
 VELOCITY_QUERY = [('@0x23/1/0x18', 'DINT')]
 POSITION_VELOCITY_QUERY = [('@0x23/1/0x0a', 'DINT')]
 
+# Seconds between state broadcasts of a device with nothing new to say
+HEARTBEAT_INTERVAL = 1.0
+
+# Retry delays after a failed poll grow by this factor up to this many seconds
+POLL_BACKOFF_MULTIPLIER = 1.5
+POLL_BACKOFF_MAX = 5.0
+
+# Telemetry senders by Socket.IO session id
+clients = {}
+
+
+startup = {
+    'begin': time.monotonic(),
+    'milestones': [],
+    'waiting_first_sample': set(),
+}
+
+
+def startup_milestone(name):
+    elapsed = time.monotonic() - startup['begin']
+    startup['milestones'].append((name, elapsed))
+    log.debug('Startup: %s after %.3fs', name, elapsed)
+
+
+def startup_report():
+    report = ', '.join('{0} {1:.3f}s'.format(name, elapsed) for name, elapsed in startup['milestones'])
+    log.info('Startup timing: %s', report)
+
 
 def failure(exc):
     log.error(exc)
 
 
-def broadcast_device_state(device, parameter='position', broadcast=True):
+def plain_state(state):
+    """ Converts unit values and targets in a controller state so it can be serialized """
+    for k, v in state.items():
+        to_dict = getattr(v, 'to_dict', None)
+        if to_dict is not None:
+            state[k] = to_dict()
+    return state
+
+
+def broadcast_device_state(device, parameter='position', broadcast=True, trace=None, on_sent=None):
 
     now = datetime.now()
     now_formatted = now.isoformat()
@@ -67,17 +106,20 @@ def broadcast_device_state(device, parameter='position', broadcast=True):
         'control_out': state['speed_cps'],
         'timestamp': now_formatted,
     })
+    if trace is not None:
+        state['trace'] = trace.to_dict()
 
-    for k, v in state.items():
-        if v.__class__ in (units.AnglePosition, units.AstronomicalPosition):
-            state[k] = v.to_dict()
-
-    socketio.emit(parameter, state, broadcast=True)
+    # Each client gets it from its own sender, see ws_connect()
+    telemetry.hub.publish(device.id, serialization.Frame(state, on_sent))
 
 
 def build_process_function(device):
+    last_broadcast = 0
+    tracer = tracing.get(device.id)
 
     def _process(par, val):
+        nonlocal last_broadcast
+
         parameter = {
             POSITION_PARAM: 'position',
             VELOCITY_PARAM: 'velocity',
@@ -88,24 +130,89 @@ def build_process_function(device):
 
         value = val[0]
 
+        trace = tracer.current
+        if trace is None or trace.computed is not None:
+            trace = tracer.start(received=time.monotonic())
+            trace.requested = trace.received
+
         controller = device.controller
-        controller.update(value)
+        with profiling.stage('update'):
+            controller.update(value, on_written=functools.partial(tracer.written, trace))
+        sequencer.process(device)
 
-        broadcast_device_state(device, parameter)
+        idle = controller.idle
+        now = trace.computed = time.monotonic()
+        if not idle and controller.computed_at is not None and controller.computed_at >= trace.received:
+            trace.computed = controller.computed_at
+
+        if idle and now - last_broadcast < HEARTBEAT_INTERVAL:
+            tracer.finish(trace, idle)
+            return
+        last_broadcast = now
+
+        devices.changed(device)
+
+        if device.id in startup['waiting_first_sample']:
+            startup['waiting_first_sample'].discard(device.id)
+            startup_milestone('first sample from {}'.format(device.id))
+            if not startup['waiting_first_sample']:
+                startup_report()
+
+        # Heartbeats of idle devices are not traced, their broadcast would only measure the polling interval
+        on_sent = None if idle else functools.partial(tracer.sent, trace)
+        with profiling.stage('broadcast'):
+            broadcast_device_state(device, parameter, trace=trace, on_sent=on_sent)
+        tracer.finish(trace, idle)
 
     return _process
 
 
+def wait_next_poll(controller, started, delay):
+    """ Sleeps until the next poll, cutting it short if a command needs faster polling meanwhile """
+    policy = controller.polling
+    while True:
+        now = time.monotonic()
+        delay = min(delay, started + policy.process(controller.polling_mode, 0) / 1000.0 - now)
+        if delay <= 0:
+            return
+        socketio.sleep(min(delay, policy.intervals['fast'] / 1000.0))
+        delay -= time.monotonic() - now
+
+
+def poll_device(device, process, failure):
+    """ Like cpppo's poll.poll() but every cycle lasts what the device polling policy says """
+    via = proxy_simple(host=device.host, port=device.port, timeout=0.5)
+    controller = device.controller
+    tracer = tracing.get(device.id)
+    backoff = None
+
+    while True:
+        started = time.monotonic()
+        cycle = controller.polling.interval / 1000.0
+        try:
+            trace = tracer.start(requested=started)
+            with profiling.stage('poll'):
+                _, delay, results = poll.loop(via, cycle=cycle, last_poll=0, params=POSITION_VELOCITY_QUERY)
+            trace.received = time.monotonic()
+            for par, val in results:
+                with profiling.stage('process'):
+                    process(par, val)
+            backoff = None
+        except Exception as exc:
+            backoff = cycle if backoff is None else min(backoff * POLL_BACKOFF_MULTIPLIER, POLL_BACKOFF_MAX)
+            delay = backoff
+            started = time.monotonic()
+            failure(exc)
+
+        wait_next_poll(controller, started, delay)
+
+
 def build_polling_task(device):
     poller = socketio.start_background_task(
-        target=poll.poll,
-        proxy_class=proxy_simple,
-        address=(device.host, device.port),
-        cycle=device.interval / 1000,
-        timeout=0.5,
+        target=poll_device,
+        device=device,
         process=build_process_function(device),
         failure=failure,
-        params=POSITION_VELOCITY_QUERY,
     )
     return poller
 
@@ -115,15 +222,63 @@ def index():
     return render_template('index.html')
 
 
+def engineio_sid(sid, namespace='/'):
+    """ The Engine.IO session carrying a Socket.IO session, python-socketio 5 numbers them apart """
+    manager = socketio.server.manager
+    if hasattr(manager, 'eio_sid_from_sid'):
+        return manager.eio_sid_from_sid(sid, namespace)
+    return sid
+
+
+def outbound_queue(eio_sid):
+    return socketio.server.eio.sockets[eio_sid].queue
+
+
+def outbound_queue_size(eio_sid):
+    """ Packets waiting to be written to the Engine.IO session of a client, 0 once it is closed """
+    try:
+        return outbound_queue(eio_sid).qsize()
+    except KeyError:
+        return 0
+
+
+@socketio.on('connect')
+def ws_connect():
+    sid = request.sid
+
+    def send(frame):
+        with profiling.stage('emit'):
+            socketio.emit('position', frame, room=sid)
+
+    subscription = telemetry.hub.subscribe(name='socket.io {}'.format(sid))
+    eio_sid = engineio_sid(sid)
+    try:
+        outbound_queue(eio_sid).qsize()
+        queued = functools.partial(outbound_queue_size, eio_sid)
+    except (AttributeError, KeyError) as e:
+        log.warning('Can not tell whether Socket.IO client %s lags behind, no outbound queue: %r', sid, e)
+        queued = lambda: 0 # noqa
+    sender = telemetry.ClientSender(subscription, send, queued)
+    clients[sid] = sender
+    socketio.start_background_task(sender.run)
+
+
+@socketio.on('disconnect')
+def ws_disconnect():
+    sender = clients.pop(request.sid, None)
+    if sender is not None:
+        sender.stop()
+
+
 @socketio.on('get_control_state')
 def ws_get_control_state(device_id=None):
     if device_id is not None:
         try:
-            return devices.get(device_id).controller.state
+            return serialization.prepare(devices.get(device_id).controller.state)
         except AttributeError:
             pass
     else:
-        return [device.controller.state for device in devices.get()]
+        return [serialization.prepare(device.controller.state) for device in devices.get()]
 
 
 @socketio.on('set_control_state')
@@ -133,38 +288,37 @@ def ws_set_control_state(device_id, new_state):
     if not device:
         return
 
-    pid_controller = device.controller.pid_controller
+    parameters = {name: new_state[name] for name in ('Kp', 'Ki', 'Kd') if new_state.get(name, None) is not None}
+    if new_state.get('alpha', None) is not None:
+        parameters['derivative_filtering'] = new_state['alpha']
+    device.controller.set_control_parameters(parameters)
 
-    Kp = new_state.get('Kp', None)
-    Ki = new_state.get('Ki', None)
-    Kd = new_state.get('Kd', None)
-    alpha = new_state.get('alpha', None)
     setpoint = new_state.get('setpoint', None)
+    if setpoint is not None:
+        device.controller.pid_controller.SetPoint = setpoint
 
-    if Kp is not None:
-        pid_controller.Kp = Kp
-
-    if Ki is not None:
-        pid_controller.Ki = Ki
+    devices.changed()
 
-    if Kd is not None:
-        pid_controller.Kd = Kd
 
-    if alpha is not None:
-        pid_controller.derivative_filter.alpha = alpha
+@socketio.on('batch')
+def ws_batch(device_commands):
+    """ Applies a list of device commands at once, see control.commands """
+    try:
+        commands.apply_batch(device_commands)
+    except (TypeError, ValueError) as e:
+        return {'error': str(e)}
 
-    if setpoint is not None:
-        pid_controller.SetPoint = setpoint
+    devices.changed()
+    return [plain_state(device.controller.state) for device in devices.get()]
 
 
 def save_state(path, *args, **kwargs):
     all_state = {}
     for device in devices.get():
-        state = device.controller.state
-        for k, v in state.items():
-            if v.__class__ in (units.AnglePosition, units.AstronomicalPosition):
-                state[k] = v.to_dict()
-        all_state[device.id] = state
+        all_state[device.id] = plain_state(device.controller.state)
+        correction = device.controller.correction
+        if correction is not None:
+            all_state[device.id]['correction'] = correction.to_dict()
 
     with open(path, 'w') as f:
         f.write(munch.munchify(all_state).toJSON(indent=4))
@@ -185,6 +339,22 @@ def load_state(path):
         return {}
 
 
+def simulate_device(device):
+    """ Drives device with a simulated motor and encoder instead of the real ones """
+    plant = simulation.SimulatedPlant(device)
+    device.serial_interface = plant
+    process = build_process_function(device)
+
+    last = time.monotonic()
+    while True:
+        now = time.monotonic()
+        plant.advance(now - last)
+        last = now
+        with profiling.stage('process'):
+            process(POSITION_VELOCITY_QUERY[0], [plant.encoder_value()])
+        wait_next_poll(device.controller, now, device.controller.polling.interval / 1000.0)
+
+
 def simulate_updates():
     while True:
         for device in devices.get():
@@ -192,7 +362,49 @@ def simulate_updates():
         socketio.sleep(.5)
 
 
-def main():
+def sidereal_clock(spawn):
+    """ Computes a new sidereal time anchor every SIDEREAL_ANCHOR_REFRESH seconds with spawn(function).
+
+    astropy runs in a native thread and the hub only gets the result, everything else (control loop,
+    astronomical gotos and syncs, broadcasts) extrapolates the anchor.
+    """
+    while True:
+        socketio.sleep(units.SIDEREAL_ANCHOR_REFRESH)
+        try:
+            spawn(units.refresh_sidereal_anchor).get()
+        except Exception as e:
+            log.error('Could not compute sidereal time: %s', e)
+
+
+def sequence_timer():
+    """ Fires sequence settle timeouts, sequences otherwise only advance when their devices are polled """
+    while True:
+        socketio.sleep(sequencer.EXPIRE_INTERVAL)
+        sequencer.expire()
+
+
+def load_astronomy():
+    """ Loads astropy in a native thread so encoder polling is not held back by it """
+    spawn = gevent.get_hub().threadpool.spawn
+    units.set_spawn(spawn)
+
+    def done(result):
+        if result.successful():
+            startup_milestone('astropy loaded')
+            log.info('astropy loaded after %.3fs', startup['milestones'][-1][1])
+            socketio.start_background_task(sidereal_clock, spawn)
+        else:
+            log.error('Could not load astropy: %s', result.exception)
+
+    loader = units.load_astropy_async(spawn)
+    loader.rawlink(done)
+    return loader
+
+
+def main(startup_begin=None):
+
+    if startup_begin is not None:
+        startup['begin'] = startup_begin
 
     initial_state = {}
     pollers = []
@@ -208,6 +420,11 @@ def main():
                         action='store_true',
                         help='Do not connect to the encoders or controllers')
 
+    parser.add_argument('--simulate',
+                        required=False,
+                        action='store_true',
+                        help='Drive simulated motors and encoders instead of the real ones')
+
     parser.add_argument('--host',
                         required=False,
                         default='127.0.0.1',
@@ -228,8 +445,34 @@ def main():
 
     parser.add_argument('--serial',
                         type=str,
-                        default='/dev/ttyACM0',
-                        help='Serial port to use for speed control (%(default)s')
+                        default=DEFAULT_SERIAL_PORT,
+                        help='Serial port to use for speed control of devices without serial_port. Defaults to %(default)s')
+
+    parser.add_argument('--serial-baudrate',
+                        type=int,
+                        default=DEFAULT_BAUDRATE,
+                        help='Serial port speed for devices without serial_baudrate. Defaults to %(default)s')
+
+    parser.add_argument('--devices',
+                        type=str,
+                        default=None,
+                        help='Comma separated ids of the devices to run, all of them if not given. Used by ethernet-servo-gateway')
+
+    parser.add_argument('--sequence-prefix',
+                        type=str,
+                        default='',
+                        help='Prepended to sequence ids. Used by ethernet-servo-gateway so workers do not reuse them')
+
+    parser.add_argument('--iers-table',
+                        type=str,
+                        required=False,
+                        default=None,
+                        help='Local IERS-A Earth orientation file (finals2000A.all). Defaults to the tables bundled with astropy')
+
+    parser.add_argument('--iers-auto-download',
+                        required=False,
+                        action='store_true',
+                        help='Allow astropy to download up to date Earth orientation data')
 
     args = parser.parse_args()
 
@@ -240,6 +483,9 @@ def main():
         logging.basicConfig()
         log.setLevel(level=logging.INFO)
 
+    units.configure(iers_table_path=args.iers_table, iers_auto_download=args.iers_auto_download)
+    startup_milestone('arguments parsed')
+
     if args.state_store_path:
         save_interval = max(args.state_save_interval, 250)
 
@@ -269,22 +515,51 @@ def main():
 
     with open(args.config, 'r') as config_file:
         config = json.load(config_file)
+        only = set(args.devices.split(',')) if args.devices else None
         for idx, device_config in enumerate(config.get('devices', [])):
+            if only is not None and device_config['id'] not in only:
+                continue
             device_config['initial_state'] = initial_state.get(device_config['id'], {})
             device = devices.create(**device_config)
 
-        if not args.dry_run:
-            serial_interface = SerialPortInterface(args.serial)
+        for path in config.get('ephemerides', []):
+            try:
+                table = ephemeris.add(ephemeris.Ephemeris.load(path))
+                log.info('Loaded ephemeris %s', table.name)
+            except (OSError, ValueError) as e:
+                log.error('Could not load ephemeris %s: %s', path, e)
+
+        if not (args.dry_run or args.simulate):
             for device in devices.get():
-                device.serial_interface = serial_interface
+                device.serial_port = device.serial_port or args.serial
+                device.serial_interface = get_serial_interface(device.serial_port,
+                                                               device.serial_baudrate or args.serial_baudrate)
 
-    if not args.dry_run:
+    startup_milestone('configuration loaded')
+
+    if args.simulate:
+        for device in devices.get():
+            log.info('Starting simulation for: %s', device)
+            startup['waiting_first_sample'].add(device.id)
+            socketio.start_background_task(simulate_device, device)
+        startup_milestone('simulation started')
+    elif not args.dry_run:
         for device in devices.get():
             log.info('Starting polling task for: %s', device)
+            startup['waiting_first_sample'].add(device.id)
             poller = build_polling_task(device)
             pollers.append(poller)
+        startup_milestone('polling started')
     else:
         socketio.start_background_task(simulate_updates)
+        startup_report()
+
+    load_astronomy()
+    sequencer.set_id_prefix(args.sequence_prefix)
+    sequencer.set_listener(lambda event: socketio.emit('sequence', event))
+    socketio.start_background_task(sequence_timer)
+    ephemeris.set_spawn(gevent.get_hub().threadpool.spawn)
+    profiling.set_spawn(gevent.get_hub().threadpool.spawn)
 
     # reloader launchs another thread for the main process and that means two instances of the controller and encoder poller but only one of them is managed by the UI. Fun times.
     socketio.run(app, host=args.host, port=args.port, use_reloader=False, debug=True, log_output=True)
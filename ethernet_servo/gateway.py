@@ -0,0 +1,638 @@
+""" Runs the devices of one configuration in several ethernet-servo processes behind a single API.
+
+Each worker is an ethernet-servo process listening on a local port and running some of the devices
+(--devices). The gateway starts and watches them, restarting any that exits, merges the device lists,
+state snapshots, batch results, profiling and the HTTP telemetry streams, and forwards every other request to
+the worker owning the device in its path. Socket.IO is not merged, clients connect to the workers.
+"""
+import gevent
+import gevent.monkey
+gevent.monkey.patch_all() # noqa
+import gevent.lock
+import gevent.event
+
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import argparse
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from gevent.pywsgi import WSGIServer
+from flask import Flask, Response, request, stream_with_context
+from flask.json import jsonify
+
+log = logging.getLogger('ethernet-encoder-servo')
+
+# Seconds to wait before restarting a worker that exited, doubled while it keeps failing up to the max
+RESTART_DELAY = 1.0
+RESTART_DELAY_MAX = 30.0
+# A worker that ran this long before exiting starts again from RESTART_DELAY
+RESTART_RESET = 60.0
+FORWARD_TIMEOUT = 10
+# Seconds between keepalives of a merged telemetry stream, as in ethernet_servo.telemetry
+KEEPALIVE = 15
+# Longest state long poll, as in ethernet_servo.api.state
+MAX_WAIT = 30
+# Longest profiler capture, as in ethernet_servo.profiling
+MAX_CAPTURE_SECONDS = 60
+
+# Namespaces whose second path component is a device
+DEVICE_NAMESPACES = ('devices', 'stream', 'tracing')
+
+app = Flask(__name__)
+
+__workers = []
+__owners = {}
+
+
+def device_id(device_config):
+    return device_config.get('id', device_config.get('name'))
+
+
+def assign(device_configs, workers):
+    """ Splits the devices among workers, as a list of device id lists.
+
+    Devices sharing a serial port stay together since only one process can write to it. Devices without a
+    serial_port are each a group of their own: they write whole lines to the --serial port of their worker, which
+    the board takes from any process. A 'worker' key in a device configuration picks its worker (0 based), the
+    other groups go to the least loaded worker.
+    """
+    groups = {}
+    pinned = {}
+    for device_config in device_configs:
+        port = device_config.get('serial_port')
+        group = port if port is not None else ('device', device_id(device_config))
+        groups.setdefault(group, []).append(device_id(device_config))
+        if device_config.get('worker') is not None:
+            pinned[group] = int(device_config['worker']) % workers
+
+    assignment = [[] for _ in range(workers)]
+    for group, ids in groups.items():
+        if group in pinned:
+            assignment[pinned[group]].extend(ids)
+    for group, ids in sorted(groups.items(), key=lambda group: -len(group[1])):
+        if group not in pinned:
+            min(assignment, key=len).extend(ids)
+
+    return [ids for ids in assignment if ids]
+
+
+class Worker:
+    """ An ethernet-servo process running some of the devices, restarted when it exits """
+    def __init__(self, name, port, devices, command):
+        self.name = name
+        self.port = port
+        self.devices = devices
+        self.command = command
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.delay = RESTART_DELAY
+        # Held while starting or stopping the process so watch() and restart() never run two of them
+        self.lock = gevent.lock.RLock()
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        with self.lock:
+            if self.alive:
+                return
+            log.info('Starting %s on port %s for %s', self.name, self.port, ', '.join(self.devices))
+            self.process = subprocess.Popen(self.command)
+            self.started = time.monotonic()
+
+    def stop(self):
+        with self.lock:
+            if self.alive:
+                self.process.terminate()
+                try:
+                    self.process.wait(5)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+
+    def restart(self):
+        with self.lock:
+            self.stop()
+            self.restarts += 1
+            self.start()
+
+    def watch(self):
+        """ Restarts the worker whenever it exits, never returns """
+        while True:
+            if self.alive:
+                gevent.sleep(1)
+                continue
+
+            if self.process is not None:
+                log.error('%s exited with code %s, restarting in %.0fs', self.name, self.process.returncode, self.delay)
+                if time.monotonic() - self.started > RESTART_RESET:
+                    self.delay = RESTART_DELAY
+                gevent.sleep(self.delay)
+                self.delay = min(self.delay * 2, RESTART_DELAY_MAX)
+
+            with self.lock:
+                # restart() may have started it while sleeping
+                if self.alive:
+                    continue
+                if self.process is not None:
+                    self.restarts += 1
+                self.start()
+
+    def url(self, path, query=''):
+        url = 'http://127.0.0.1:{0}/api/{1}'.format(self.port, path)
+        if query:
+            url += '?' + query
+        return url
+
+    def request(self, method, path, query='', body=None, headers=None, timeout=FORWARD_TIMEOUT):
+        """ Sends a request to the worker, returns (status, response headers, body) """
+        forwarded = urllib.request.Request(self.url(path, query), data=body, method=method, headers=headers or {})
+        try:
+            with urllib.request.urlopen(forwarded, timeout=timeout) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+        except OSError as e:
+            message = json.dumps({'message': '{0} is not available: {1}'.format(self.name, e)}).encode('utf-8')
+            return 503, {'Content-Type': 'application/json'}, message
+
+    def forward(self, method, path, query='', body=None, headers=None, timeout=FORWARD_TIMEOUT):
+        """ Sends a request to the worker, returns (status, content type, body) """
+        status, response_headers, response_body = self.request(method, path, query, body, headers, timeout)
+        return status, response_headers.get('Content-Type'), response_body
+
+    def get_json(self, path, query=''):
+        status, _, body = self.forward('GET', path, query)
+        if status != 200:
+            raise OSError('{0} answered {1} to {2}'.format(self.name, status, path))
+        return json.loads(body.decode('utf-8'))
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'port': self.port,
+            'devices': self.devices,
+            'alive': self.alive,
+            'pid': self.process.pid if self.process is not None else None,
+            'restarts': self.restarts,
+        }
+
+
+def get_worker(name):
+    for worker in __workers:
+        if worker.name == name:
+            return worker
+    return None
+
+
+def owner(device):
+    return __owners.get(device)
+
+
+def sequence_prefix(worker_name):
+    return '{}-'.format(worker_name)
+
+
+def sequence_worker(sequence_id):
+    """ The worker running a sequence, told by the prefix it gave its id """
+    for worker in __workers:
+        if sequence_id.startswith(sequence_prefix(worker.name)):
+            return worker
+    return None
+
+
+def sequence_devices(payload):
+    """ Ids of the devices commanded by the steps of a new sequence, the worker validates the rest """
+    steps = payload.get('steps') if isinstance(payload, dict) else None
+    for step in steps if isinstance(steps, list) else []:
+        step_commands = step.get('commands') if isinstance(step, dict) else None
+        for command in step_commands if isinstance(step_commands, list) else []:
+            if isinstance(command, dict):
+                yield command.get('device')
+
+
+def as_response(status, content_type, body):
+    return Response(body, status=status, content_type=content_type or 'application/json')
+
+
+def error(status, message):
+    response = jsonify({'message': message})
+    response.status_code = status
+    return response
+
+
+def merged(path):
+    """ Concatenates the lists answered by every worker """
+    result = []
+    for worker in __workers:
+        try:
+            result.extend(worker.get_json(path, request.query_string.decode('utf-8')))
+        except OSError as e:
+            log.warning('%s', e)
+    return result
+
+
+@app.route('/api/devices/')
+def devices_list():
+    return jsonify(merged('devices/'))
+
+
+@app.route('/api/tracing/')
+def tracing_list():
+    return jsonify(merged('tracing/'))
+
+
+def merge_profiling(answers):
+    """ Adds up the stage timings of every worker, enabled only if it is in all of them """
+    stages = {}
+    for answer in answers:
+        for stage in answer['stages']:
+            merged_stage = stages.get(stage['name'])
+            if merged_stage is None:
+                stages[stage['name']] = dict(stage)
+                continue
+            if stage['count']:
+                merged_stage['min'] = min(merged_stage['min'], stage['min']) if merged_stage['count'] else stage['min']
+            merged_stage['count'] += stage['count']
+            merged_stage['total'] += stage['total']
+            merged_stage['max'] = max(merged_stage['max'], stage['max'])
+            merged_stage['mean'] = merged_stage['total'] / merged_stage['count'] if merged_stage['count'] else 0
+
+    return {
+        'enabled': bool(answers) and all(answer['enabled'] for answer in answers),
+        'elapsed': max((answer['elapsed'] for answer in answers), default=0),
+        'stages': [stages[name] for name in sorted(stages)],
+    }
+
+
+@app.route('/api/profiling/', methods=['GET', 'PUT', 'DELETE'])
+def profiling_stats():
+    """ Applies the request to every worker and merges their stage timings, see merge_profiling() """
+    body = request.get_data() or None
+    headers = {'Content-Type': request.headers.get('Content-Type', 'application/json')}
+
+    answers = []
+    unavailable = []
+    for worker in __workers:
+        status, content_type, response_body = worker.forward(request.method, 'profiling/', body=body, headers=headers)
+        if 400 <= status < 500:
+            return as_response(status, content_type, response_body)
+        if status != 200:
+            log.warning('%s answered %s to profiling/', worker.name, status)
+            unavailable.append(worker.name)
+            continue
+        answers.append(json.loads(response_body.decode('utf-8')))
+
+    result = merge_profiling(answers)
+    result['unavailable'] = unavailable
+    return jsonify(result)
+
+
+@app.route('/api/profiling/capture')
+def profiling_capture():
+    """ Captures every worker at once, each stack starts with the name of its worker """
+    query = request.query_string.decode('utf-8')
+    captures = [
+        gevent.spawn(worker.forward, 'GET', 'profiling/capture', query, timeout=MAX_CAPTURE_SECONDS + FORWARD_TIMEOUT)
+        for worker in __workers
+    ]
+    gevent.joinall(captures)
+
+    stacks = []
+    for worker, capture in zip(__workers, captures):
+        status, content_type, body = capture.value
+        if 400 <= status < 500:
+            return as_response(status, content_type, body)
+        if status != 200:
+            log.warning('%s answered %s to profiling/capture', worker.name, status)
+            continue
+        stacks.extend('{0};{1}'.format(worker.name, line) for line in body.decode('utf-8').splitlines() if line)
+
+    return Response('\n'.join(stacks) + '\n', mimetype='text/plain', headers={
+        'Content-Disposition': 'attachment; filename=profile.folded',
+    })
+
+
+def state_etag(worker_etags):
+    """ One etag made of the etag of every worker, empty for workers that did not answer """
+    return '"{}"'.format('+'.join(tag.strip('"') for tag in worker_etags))
+
+
+def requested_worker_etags():
+    """ The worker etags in an If-None-Match made by state_etag(), None if it does not have one per worker """
+    for tag in request.headers.get('If-None-Match', '').split(','):
+        parts = tag.strip().replace('W/', '', 1).strip('"').split('+')
+        if len(parts) == len(__workers):
+            return ['"{}"'.format(part) if part else '' for part in parts]
+    return None
+
+
+def wait_for_state_change(worker_etags, wait):
+    """ Long polls every worker that answered with its own etag, returns once any of them changes """
+    polls = [
+        gevent.spawn(worker.request, 'GET', 'state/', urllib.parse.urlencode({'wait': wait}),
+                     headers={'If-None-Match': tag}, timeout=wait + FORWARD_TIMEOUT)
+        for worker, tag in zip(__workers, worker_etags) if tag
+    ]
+    if not polls:
+        gevent.sleep(wait)
+        return
+
+    try:
+        for poll in gevent.iwait(polls):
+            if not poll.successful() or poll.value[0] != 304:
+                return
+    finally:
+        gevent.killall(polls, block=False)
+
+
+@app.route('/api/state/')
+def state_snapshot():
+    """ State of every device, the version is the sum of the worker versions so it grows until a worker restarts.
+
+    Supports If-None-Match and wait like a single server. Workers that do not answer are listed in unavailable.
+    """
+    known = requested_worker_etags()
+    try:
+        wait = min(float(request.args.get('wait', 0)), MAX_WAIT)
+    except ValueError:
+        return error(400, 'wait must be a number of seconds')
+    if known is not None and wait > 0:
+        wait_for_state_change(known, wait)
+
+    version = 0
+    device_states = []
+    unavailable = []
+    worker_etags = []
+    for worker in __workers:
+        status, headers, body = worker.request('GET', 'state/')
+        if status != 200:
+            log.warning('%s answered %s to state/', worker.name, status)
+            unavailable.append(worker.name)
+            worker_etags.append('')
+            continue
+        snapshot = json.loads(body.decode('utf-8'))
+        version += snapshot['version']
+        device_states.extend(snapshot['devices'])
+        worker_etags.append(headers.get('ETag', ''))
+
+    headers = {
+        'ETag': state_etag(worker_etags),
+        'Cache-Control': 'no-cache',
+    }
+    if known == worker_etags:
+        return Response(status=304, headers=headers)
+
+    response = jsonify({'version': version, 'devices': device_states, 'unavailable': unavailable})
+    response.headers.extend(headers)
+    return response
+
+
+@app.route('/api/sequences/')
+def sequences_list():
+    return jsonify(merged('sequences/'))
+
+
+@app.route('/api/sequences/', methods=['POST'])
+def sequence_start():
+    """ Starts a sequence on the worker running its devices. Sequences are advanced by the control loop of a
+    worker, so they can not move devices of several workers.
+    """
+    payload = request.get_json(silent=True)
+    workers = {}
+    for device in sequence_devices(payload):
+        worker = owner(device)
+        if worker is not None:
+            workers.setdefault(worker.name, []).append(device)
+    if len(workers) > 1:
+        return error(400, 'A sequence can only move devices run by one worker, got {}'.format(
+            '; '.join('{0} on {1}'.format(', '.join(sorted(set(ids))), name) for name, ids in sorted(workers.items()))))
+
+    worker = get_worker(next(iter(workers))) if workers else __workers[0]
+    return as_response(*worker.forward('POST', 'sequences/', body=request.get_data(),
+                                       headers={'Content-Type': 'application/json'}))
+
+
+@app.route('/api/batch/', methods=['POST'])
+def batch():
+    """ Splits the commands by worker. Each worker applies its part at once, but not together with the others """
+    device_commands = request.get_json(silent=True)
+    if not isinstance(device_commands, list):
+        return error(400, 'Expected a list of commands')
+
+    parts = {}
+    for command in device_commands:
+        worker = owner(command.get('device')) if isinstance(command, dict) else None
+        if worker is None:
+            return error(400, 'Unknown device in command: {}'.format(command))
+        parts.setdefault(worker.name, []).append(command)
+
+    statuses = []
+    for worker in __workers:
+        if worker.name not in parts:
+            continue
+        status, content_type, body = worker.forward('POST', 'batch/', body=json.dumps(parts[worker.name]).encode('utf-8'),
+                                                    headers={'Content-Type': 'application/json'})
+        if status != 200:
+            return as_response(status, content_type, body)
+        statuses.extend(json.loads(body.decode('utf-8')))
+    return jsonify(statuses)
+
+
+@app.route('/api/stream/')
+def stream():
+    """ Merges the telemetry streams of every worker into one """
+    stream_format = request.args.get('format')
+    if stream_format is None:
+        stream_format = 'sse' if 'text/event-stream' in request.headers.get('Accept', '') else 'ndjson'
+
+    query = dict(request.args)
+    query['format'] = 'ndjson'
+    query = urllib.parse.urlencode(query)
+
+    # Only the latest frame of each device waits to be sent, like telemetry.Subscription, so a slow client
+    # skips frames instead of growing the gateway memory
+    pending = {'frames': {}}
+    arrived = gevent.event.Event()
+
+    def follow(worker):
+        while True:
+            try:
+                with urllib.request.urlopen(worker.url('stream/', query), timeout=KEEPALIVE * 2) as response:
+                    for line in response:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        line = line.decode('utf-8')
+                        try:
+                            device = json.loads(line).get('id')
+                        except ValueError:
+                            continue
+                        pending['frames'][device] = line
+                        arrived.set()
+            except OSError:
+                gevent.sleep(RESTART_DELAY)
+
+    followers = [gevent.spawn(follow, worker) for worker in __workers]
+
+    def generate():
+        try:
+            while True:
+                if not pending['frames']:
+                    arrived.wait(KEEPALIVE)
+                arrived.clear()
+
+                frames, pending['frames'] = pending['frames'], {}
+                if not frames:
+                    yield ': keepalive\n\n' if stream_format == 'sse' else '\n'
+                    continue
+
+                for line in frames.values():
+                    if stream_format == 'sse':
+                        yield 'event: position\ndata: {}\n\n'.format(line)
+                    else:
+                        yield line + '\n'
+        finally:
+            gevent.killall(followers, block=False)
+
+    mimetype = 'text/event-stream' if stream_format == 'sse' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+@app.route('/api/workers/')
+def workers_list():
+    return jsonify([worker.to_dict() for worker in __workers])
+
+
+@app.route('/api/workers/<string:name>/restart', methods=['POST'])
+def worker_restart(name):
+    worker = get_worker(name)
+    if worker is None:
+        return error(404, "Worker '{}' does not exist".format(name))
+    worker.restart()
+    return jsonify(worker.to_dict())
+
+
+@app.route('/api/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
+def forward(path):
+    """ Requests about a device or a sequence go to its worker, ephemeris changes to all of them, anything else to
+    the worker given in the worker parameter or the first one.
+    """
+    parts = path.split('/')
+    body = request.get_data() or None
+    headers = {'Content-Type': request.headers.get('Content-Type', 'application/json')}
+    query = request.query_string.decode('utf-8')
+
+    if parts[0] in DEVICE_NAMESPACES and len(parts) > 1 and parts[1]:
+        worker = owner(parts[1])
+        if worker is None:
+            return error(404, "Device '{}' does not exist".format(parts[1]))
+        if parts[0] == 'stream':
+            return forward_stream(worker, path, query)
+        return as_response(*worker.forward(request.method, path, query, body, headers))
+
+    if parts[0] == 'sequences' and len(parts) > 1 and parts[1]:
+        worker = sequence_worker(parts[1])
+        if worker is None:
+            return error(404, "Sequence '{}' does not exist".format(parts[1]))
+        if parts[-1] == 'events':
+            return forward_stream(worker, path, query)
+        return as_response(*worker.forward(request.method, path, query, body, headers))
+
+    if parts[0] == 'ephemeris' and request.method != 'GET':
+        answers = [worker.forward(request.method, path, query, body, headers) for worker in __workers]
+        failed = [answer for answer in answers if answer[0] >= 400]
+        return as_response(*(failed[0] if failed else answers[0]))
+
+    worker = get_worker(request.args.get('worker')) or __workers[0]
+    return as_response(*worker.forward(request.method, path, query, body, headers))
+
+
+def forward_stream(worker, path, query):
+    forwarded = urllib.request.Request(worker.url(path, query), headers={'Accept': request.headers.get('Accept', '*/*')})
+    try:
+        upstream = urllib.request.urlopen(forwarded, timeout=KEEPALIVE * 2)
+    except urllib.error.HTTPError as e:
+        return as_response(e.code, e.headers.get('Content-Type'), e.read())
+    except OSError as e:
+        return error(503, '{0} is not available: {1}'.format(worker.name, e))
+
+    def generate():
+        with upstream:
+            for chunk in upstream:
+                yield chunk
+
+    return Response(stream_with_context(generate()), content_type=upstream.headers.get('Content-Type'), headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--debug', action='store_true', help='Shows debug messages')
+    parser.add_argument('--config', required=True, help='Path to the configuration JSON file')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of worker processes, at most one per device. Defaults to the number of CPUs')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='The hostname or IP address for the gateway to listen on. Defaults to %(default)s')
+    parser.add_argument('--port', type=int, default=5000,
+                        help='The port number for the gateway to listen on. Defaults to %(default)s')
+    parser.add_argument('--worker-port', type=int, default=None,
+                        help='Port of the first worker, the others use the next ones. Defaults to --port + 1')
+    parser.add_argument('--state-store-path', type=str, default='',
+                        help='Path to load and save encoder status, each worker uses its own file next to it')
+
+    args, worker_args = parser.parse_known_args(argv)
+
+    logging.basicConfig()
+    log.setLevel(logging.DEBUG if args.debug else logging.INFO)
+
+    with open(args.config, 'r') as config_file:
+        config = json.load(config_file)
+
+    worker_port = args.worker_port or args.port + 1
+    for n, ids in enumerate(assign(config.get('devices', []), max(args.workers, 1))):
+        name = 'worker{}'.format(n)
+        command = [sys.executable, '-c', 'from ethernet_servo import main; main()', '--config', args.config,
+                   '--port', str(worker_port + n), '--devices', ','.join(ids),
+                   '--sequence-prefix', sequence_prefix(name)]
+        if args.state_store_path:
+            root, extension = os.path.splitext(args.state_store_path)
+            command += ['--state-store-path', '{0}.{1}{2}'.format(root, name, extension)]
+        if args.debug:
+            command.append('--debug')
+
+        worker = Worker(name, worker_port + n, ids, command + worker_args)
+        __workers.append(worker)
+        for device in ids:
+            __owners[device] = worker
+
+    def exit_handler(*a, **k):
+        log.info('Stopping workers')
+        for worker in __workers:
+            worker.stop()
+        sys.exit(0)
+
+    gevent.signal_handler(signal.SIGTERM, exit_handler)
+    gevent.signal_handler(signal.SIGINT, exit_handler)
+
+    for worker in __workers:
+        gevent.spawn(worker.watch)
+
+    WSGIServer((args.host, args.port), app).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+""" Finds how many axes a server sustains at a polling interval, against local stand-ins for the hardware.
+
+Each encoder is a cpppo EtherNet/IP server answering @0x23/1/0x0a with a position that keeps turning, the
+step/direction board is a pseudo-terminal. ethernet-servo is started against them with a generated
+configuration, every axis is set running, and the server's trace counters tell how often each one really got a
+control cycle. The telemetry stream only gives the cycle durations, it coalesces frames when the reader lags.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from collections import defaultdict
+
+
+POSITION_TAG = 'position@0x23/1/0x0a=DINT'
+COUNTS_PER_REVOLUTION = 262144
+
+# A setup sustains an interval if every axis gets at least this fraction of the expected control cycles
+MIN_RATE_FRACTION = 0.9
+# ... and 90% of its cycles take less than this many intervals
+MAX_P90_INTERVALS = 1.5
+
+# Encoder speed in counts per second
+DEFAULT_ENCODER_SPEED = 2000
+SERVER_START_TIMEOUT = 60
+
+
+def serve_encoder(port, speed):
+    """ Runs a simulated absolute encoder turning at speed counts per second, never returns """
+    from cpppo.server.enip import device, main
+
+    started = time.time()
+
+    class TurningPosition(device.Attribute):
+        @property
+        def value(self):
+            return int((time.time() - started) * speed) % COUNTS_PER_REVOLUTION
+
+        @value.setter
+        def value(self, v):
+            pass
+
+    main.main(argv=['--address', '127.0.0.1:{}'.format(port), POSITION_TAG], attribute_class=TurningPosition)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class SerialStandIn:
+    """ A pseudo-terminal playing the step/direction board, counts the speed commands written to it """
+    def __init__(self):
+        self.master, self.slave = os.openpty()
+        self.path = os.ttyname(self.slave)
+        self.frames = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.__read, daemon=True)
+        self.thread.start()
+
+    def __read(self):
+        while not self.closed:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return
+            self.frames += data.count(b'\n') // 2
+
+    def close(self):
+        self.closed = True
+        os.close(self.slave)
+        os.close(self.master)
+
+
+def config_for(axes, interval):
+    """ Configuration for axes encoders on consecutive local ports, polled every interval milliseconds """
+    return {
+        'devices': [{
+            'name': 'AXIS{}'.format(n),
+            'id': 'AXIS{}'.format(n),
+            'host': '127.0.0.1',
+            'port': free_port(),
+            'interval': interval,
+            'min_interval': interval,
+            'max_interval': interval,
+            'axis': 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'[n % 26],
+            'gear_ratio_num': 1,
+            'gear_ratio_den': 1,
+        } for n in range(axes)]
+    }
+
+
+def api(port, path, payload=None, timeout=5):
+    data = json.dumps(payload).encode('utf-8') if payload is not None else None
+    request = urllib.request.Request('http://127.0.0.1:{0}/api/{1}'.format(port, path), data=data,
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def wait_for_server(port, process, timeout=SERVER_START_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('ethernet-servo exited with code {}'.format(process.returncode))
+        try:
+            return api(port, 'devices/', timeout=1)
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError('ethernet-servo did not start in {}s'.format(timeout))
+
+
+def control_cycles(port):
+    """ Control cycles run by every device since the server started """
+    return {tracer['device']: tracer['cycles'] for tracer in api(port, 'tracing/')}
+
+
+def measure(port, duration):
+    """ Control cycle durations of every device seen in the telemetry stream during duration seconds """
+    cycles = defaultdict(list)
+    url = 'http://127.0.0.1:{}/api/stream/?format=ndjson&fields=dt'.format(port)
+    deadline = time.monotonic() + duration
+    with urllib.request.urlopen(url, timeout=duration + 5) as response:
+        for line in response:
+            if time.monotonic() > deadline:
+                break
+            line = line.strip()
+            if line:
+                sample = json.loads(line.decode('utf-8'))
+                cycles[sample['id']].append(sample['dt'])
+    return cycles
+
+
+def run_step(axes, interval, duration, encoder_speed, server_args=()):
+    """ Runs a server with axes encoders, returns the measured rates and whether it kept up """
+    config = config_for(axes, interval)
+    serial = SerialStandIn()
+    processes = []
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as config_file:
+        json.dump(config, config_file)
+
+    try:
+        for device in config['devices']:
+            processes.append(subprocess.Popen(
+                [sys.executable, '-m', 'ethernet_servo.loadtest', '--encoder-port', str(device['port']),
+                 '--encoder-speed', str(encoder_speed)],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+        port = free_port()
+        server = subprocess.Popen(
+            [sys.executable, '-c', 'from ethernet_servo import main; main()', '--config', config_file.name,
+             '--port', str(port), '--serial', serial.path] + list(server_args),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        processes.append(server)
+
+        wait_for_server(port, server)
+
+        # Free running at the speed the encoders turn, so every axis is closed loop and writes its speed
+        speed = encoder_speed * 360.0 / COUNTS_PER_REVOLUTION
+        api(port, 'batch/', [{'device': device['name'], 'command': 'run_speed', 'degrees': 0, 'minutes': 0,
+                              'seconds': speed * 3600} for device in config['devices']])
+
+        # Let polling settle before measuring
+        time.sleep(2)
+        frames_before = serial.frames
+        cycles_before = control_cycles(port)
+        started = time.monotonic()
+        durations = measure(port, duration)
+        cycles_after = control_cycles(port)
+        measured = time.monotonic() - started
+        frames = serial.frames - frames_before
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        serial.close()
+        os.unlink(config_file.name)
+
+    expected = measured * 1000.0 / interval
+    rates = []
+    p90s = []
+    for device in config['devices']:
+        name = device['name']
+        rates.append((cycles_after.get(name, 0) - cycles_before.get(name, 0)) / expected)
+        dts = sorted(durations.get(name, []))
+        p90s.append(dts[int(0.9 * (len(dts) - 1))] if dts else float('inf'))
+
+    worst_rate = min(rates)
+    worst_p90 = max(p90s)
+    sustained = worst_rate >= MIN_RATE_FRACTION and worst_p90 <= MAX_P90_INTERVALS * interval / 1000.0
+
+    return {
+        'axes': axes,
+        'interval': interval,
+        'worst_rate': worst_rate,
+        'worst_p90_dt': worst_p90,
+        'serial_frames_per_second': frames / measured,
+        'sustained': sustained,
+    }
+
+
+def parse_list(value):
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--axes', type=parse_list, default=[1, 2, 4, 8, 16],
+                        help='Comma separated numbers of axes to try, in order. Defaults to 1,2,4,8,16')
+    parser.add_argument('--interval', type=parse_list, default=[50],
+                        help='Comma separated polling intervals in milliseconds to try. Defaults to 50')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds measured for each step. Defaults to %(default)s')
+    parser.add_argument('--encoder-speed', type=float, default=DEFAULT_ENCODER_SPEED,
+                        help='Simulated encoder speed in counts per second. Defaults to %(default)s')
+    parser.add_argument('--keep-going', action='store_true',
+                        help='Keep trying more axes after a step could not keep up')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    parser.add_argument('--encoder-port', type=int, help=argparse.SUPPRESS)
+
+    args, server_args = parser.parse_known_args(argv)
+
+    if args.encoder_port:
+        serve_encoder(args.encoder_port, args.encoder_speed)
+        return
+
+    results = []
+    capacity = {}
+    for interval in args.interval:
+        capacity[interval] = 0
+        for axes in args.axes:
+            result = run_step(axes, interval, args.duration, args.encoder_speed, server_args)
+            results.append(result)
+            if not args.json:
+                print('{axes:3d} axes every {interval:4d}ms: {rate:6.1%} of cycles, p90 cycle {p90:6.1f}ms, '
+                      '{frames:7.1f} serial frames/s  {verdict}'.format(
+                          axes=axes, interval=interval, rate=result['worst_rate'],
+                          p90=result['worst_p90_dt'] * 1000.0, frames=result['serial_frames_per_second'],
+                          verdict='ok' if result['sustained'] else 'OVERRUN'))
+            if result['sustained']:
+                capacity[interval] = max(capacity[interval], axes)
+            elif not args.keep_going:
+                break
+
+    if args.json:
+        print(json.dumps({'results': results, 'capacity': capacity}, indent=4))
+    else:
+        for interval, axes in capacity.items():
+            print('Sustained {0} axes polled every {1}ms'.format(axes, interval))
+
+
+if __name__ == '__main__':
+    main()
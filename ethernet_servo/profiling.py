@@ -0,0 +1,168 @@
+import sys
+import time
+from collections import Counter
+
+
+# Default seconds and sampling period of a profiler capture
+DEFAULT_CAPTURE_SECONDS = 5.0
+DEFAULT_CAPTURE_INTERVAL = 0.005
+MAX_CAPTURE_SECONDS = 60.0
+
+__profiling = {
+    'enabled': False,
+    'stages': {},
+    'since': time.monotonic(),
+    # How captures are run, see set_spawn()
+    'spawn': None,
+}
+
+
+class StageStats:
+    """ Timing aggregates of one stage, in seconds """
+    __slots__ = ('count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        if self.min is None or elapsed < self.min:
+            self.min = elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0,
+            'min': self.min or 0,
+            'max': self.max,
+        }
+
+
+class _Timer:
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_no_timer = _NoTimer()
+
+
+def enabled():
+    return __profiling['enabled']
+
+
+def enable(value=True):
+    """ Turns stage timing on or off, starting new aggregates when turned on """
+    if value and not __profiling['enabled']:
+        reset()
+    __profiling['enabled'] = bool(value)
+
+
+def reset():
+    __profiling['stages'] = {}
+    __profiling['since'] = time.monotonic()
+
+
+def stage(name):
+    """ Context manager timing a stage while profiling is enabled, it costs next to nothing otherwise:
+
+        with profiling.stage('update.pid'):
+            ...
+    """
+    if __profiling['enabled']:
+        return _Timer(name)
+    return _no_timer
+
+
+def record(name, elapsed):
+    stages = __profiling['stages']
+    stats = stages.get(name)
+    if stats is None:
+        stats = stages[name] = StageStats()
+    stats.add(elapsed)
+
+
+def stats():
+    stages = __profiling['stages']
+    return {
+        'enabled': __profiling['enabled'],
+        'elapsed': time.monotonic() - __profiling['since'],
+        'stages': [dict(stages[name].to_dict(), name=name) for name in sorted(stages)],
+    }
+
+
+def set_spawn(spawn):
+    """ Runs profiler captures with spawn(function, *args), which must return something with get().
+
+    It has to be a native thread: the sampler sleeps between samples and everything else has to keep running.
+    """
+    __profiling['spawn'] = spawn
+
+
+class SamplingProfiler:
+    """ Samples the stack of every other thread every interval seconds.
+
+    The result is in the collapsed format used by flamegraph.pl and speedscope: one line per distinct
+    stack, outermost frame first, followed by how many samples were in it.
+    """
+    def __init__(self, interval=DEFAULT_CAPTURE_INTERVAL):
+        self.interval = interval
+        self.samples = Counter()
+
+    def run(self, seconds):
+        own_code = SamplingProfiler.run.__code__
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for frame in sys._current_frames().values():
+                stack = []
+                while frame is not None:
+                    if frame.f_code is own_code:
+                        break
+                    code = frame.f_code
+                    stack.append('{0} ({1}:{2})'.format(code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                else:
+                    self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+        return self.collapsed()
+
+    def collapsed(self):
+        return ''.join('{0} {1}\n'.format(stack, count) for stack, count in self.samples.most_common())
+
+
+def capture(seconds=DEFAULT_CAPTURE_SECONDS, interval=DEFAULT_CAPTURE_INTERVAL):
+    """ Runs a sampling profiler for seconds and returns the collapsed stacks """
+    seconds = min(max(seconds, interval), MAX_CAPTURE_SECONDS)
+    profiler = SamplingProfiler(interval)
+
+    spawn = __profiling['spawn']
+    if spawn is None:
+        return profiler.run(seconds)
+    return spawn(profiler.run, seconds).get()
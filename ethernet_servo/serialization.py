@@ -0,0 +1,96 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Decimal places kept for each field, wherever it appears. Finer digits are below what the encoders resolve.
+FIELD_PRECISION = {
+    'position': 1,
+    'value': 1,
+    'target': 1,
+    'setpoint': 1,
+    'offset': 1,
+    'error': 1,
+    'output': 1,
+    'control_out': 1,
+    'speed_cps': 1,
+    'feedforward_cps': 1,
+    'run_speed_raw': 1,
+    'speed_hz': 2,
+    'seconds': 3,
+    'dt': 4,
+}
+DEFAULT_PRECISION = 6
+
+_encoder = json.JSONEncoder(separators=(',', ':'), check_circular=False)
+
+
+def encode(data):
+    """ Compact JSON text, using orjson when it is installed """
+    if orjson is not None:
+        return orjson.dumps(data).decode('utf-8')
+    return _encoder.encode(data)
+
+
+def prepare(value, precision=DEFAULT_PRECISION):
+    """ Rounds floats to the precision of their field and turns unit values into dicts, in one pass """
+    if isinstance(value, float):
+        return round(value, precision)
+
+    if isinstance(value, dict):
+        return {k: prepare(v, FIELD_PRECISION.get(k, precision)) for k, v in value.items()}
+
+    if isinstance(value, (list, tuple)):
+        return [prepare(v, precision) for v in value]
+
+    to_dict = getattr(value, 'to_dict', None)
+    if to_dict is not None:
+        return prepare(to_dict(), precision)
+
+    return value
+
+
+class Frame:
+    """ A telemetry sample, encoded at most once for each set of fields and shared by every client.
+
+    on_sent() is called whenever the frame is actually sent to a client, see sent().
+    """
+    __slots__ = ('data', 'encoded', 'on_sent')
+
+    def __init__(self, state, on_sent=None):
+        self.data = prepare(state)
+        self.encoded = {}
+        self.on_sent = on_sent
+
+    def sent(self):
+        if self.on_sent is not None:
+            self.on_sent()
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def to_json(self, fields=None):
+        key = tuple(fields) if fields else ()
+        text = self.encoded.get(key)
+        if text is None:
+            data = self.data
+            if fields:
+                data = {k: data[k] for k in fields if k in data}
+                data['id'] = self.data.get('id')
+            text = self.encoded[key] = encode(data)
+        return text
+
+
+def dumps(obj, *args, **kwargs):
+    """ json.dumps() that inserts frames already encoded, so Socket.IO packets reuse them """
+    if isinstance(obj, list) and any(isinstance(item, Frame) for item in obj):
+        return '[' + ','.join(
+            item.to_json() if isinstance(item, Frame) else json.dumps(item, *args, **kwargs) for item in obj
+        ) + ']'
+    return json.dumps(obj, *args, **kwargs)
+
+
+loads = json.loads
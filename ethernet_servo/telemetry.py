@@ -0,0 +1,123 @@
+import time
+import threading
+
+
+# Seconds between keepalives when there is nothing to send
+KEEPALIVE = 15
+
+# A client with more outbound packets than this waiting to be written is lagging behind
+MAX_QUEUED = 4
+# Slowest period between frames for lagging clients, in seconds
+MAX_PERIOD = 2.0
+# First period used when a client starts lagging, doubled while it keeps lagging
+LAGGING_PERIOD = 0.1
+
+
+class Subscription:
+    """ Frames waiting to be sent to one client.
+
+    Only the latest frame of each device is kept: a slow reader skips samples instead of making the server
+    buffer them, skipped frames are counted in dropped.
+    """
+    def __init__(self, hub, device_ids=None, name=''):
+        self.hub = hub
+        self.name = name
+        self.device_ids = set(device_ids) if device_ids else None
+        self.pending = {}
+        self.dropped = 0
+        self.delivered = 0
+        self.period = 0
+        self.closed = False
+        self.event = threading.Event()
+
+    def wants(self, device_id):
+        return self.device_ids is None or device_id in self.device_ids
+
+    def push(self, device_id, frame):
+        if device_id in self.pending:
+            self.dropped += 1
+        self.pending[device_id] = frame
+        self.event.set()
+
+    def get(self, timeout=None):
+        """ Waits up to timeout seconds for new frames, returns them as {device_id: frame} """
+        if not self.pending:
+            self.event.wait(timeout)
+        self.event.clear()
+
+        frames, self.pending = self.pending, {}
+        self.delivered += len(frames)
+        return frames
+
+    def close(self):
+        self.closed = True
+        self.hub.unsubscribe(self)
+        self.event.set()
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'devices': sorted(self.device_ids) if self.device_ids else [],
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'rate': 1.0 / self.period if self.period else 0,
+        }
+
+
+class Hub:
+    """ Hands the frame of every control cycle to whoever is streaming telemetry """
+    def __init__(self):
+        self.subscriptions = []
+        self.latest = {}
+
+    def publish(self, device_id, frame):
+        self.latest[device_id] = frame
+        for subscription in self.subscriptions:
+            if subscription.wants(device_id):
+                subscription.push(device_id, frame)
+
+    def subscribe(self, device_ids=None, name=''):
+        subscription = Subscription(self, device_ids, name)
+        self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+
+
+class ClientSender:
+    """ Sends frames to one Socket.IO client no faster than it can take them.
+
+    send(frame) queues a frame for the client and queued() tells how many packets are still waiting to be
+    written to it. While a client lags behind its frames are dropped and the period between frames doubles,
+    up to MAX_PERIOD, then halves again once it catches up.
+    """
+    def __init__(self, subscription, send, queued):
+        self.subscription = subscription
+        self.send = send
+        self.queued = queued
+
+    def run(self):
+        subscription = self.subscription
+        while not subscription.closed:
+            frames = subscription.get(timeout=KEEPALIVE)
+
+            if self.queued() > MAX_QUEUED:
+                subscription.delivered -= len(frames)
+                subscription.dropped += len(frames)
+                subscription.period = min(MAX_PERIOD, max(LAGGING_PERIOD, 2 * subscription.period))
+            else:
+                for frame in frames.values():
+                    self.send(frame)
+                    frame.sent()
+                if subscription.period and self.queued() == 0:
+                    subscription.period = subscription.period / 2 if subscription.period > LAGGING_PERIOD else 0
+
+            if subscription.period:
+                time.sleep(subscription.period)
+
+    def stop(self):
+        self.subscription.close()
+
+
+hub = Hub()
@@ -0,0 +1,134 @@
+import math
+import time
+from collections import deque
+
+
+# Latest samples kept by each device to compute latency percentiles
+TRACE_HISTORY = 1000
+PERCENTILES = [50, 90, 99]
+
+# Latencies reported for each device, as (name, from stamp, to stamp)
+SEGMENTS = [
+    ('network', 'requested', 'received'),
+    ('control', 'received', 'computed'),
+    ('serial', 'computed', 'written'),
+    ('sensor_to_actuator', 'received', 'written'),
+    ('request_to_actuator', 'requested', 'written'),
+    ('broadcast', 'received', 'broadcast'),
+]
+# Stamps known when a control cycle finishes. The serial writer and the telemetry senders stamp written and
+# broadcast later, once the motor command and the frame really went out.
+STAMPS = ('requested', 'received', 'computed')
+
+__tracers = {}
+
+
+class SampleTrace:
+    """ Monotonic timestamps, in seconds, of one encoder sample going through the server """
+    __slots__ = ('id', 'requested', 'received', 'computed', 'written', 'broadcast', 'finished', 'idle')
+
+    def __init__(self, trace_id, requested, received=None):
+        self.id = trace_id
+        self.requested = requested
+        self.received = received
+        self.computed = None
+        self.written = None
+        self.broadcast = None
+        self.finished = False
+        self.idle = False
+
+    def to_dict(self):
+        trace = {name: getattr(self, name) for name in STAMPS}
+        trace['id'] = self.id
+        return trace
+
+
+def percentile(ordered, p):
+    """ Nearest rank percentile of an ordered list """
+    rank = int(math.ceil(p / 100.0 * len(ordered)))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+class Tracer:
+    """ Numbers the samples of a device and keeps the latencies of the last TRACE_HISTORY of them """
+    def __init__(self, device_id, history=TRACE_HISTORY):
+        self.device_id = device_id
+        self.next_id = 1
+        self.cycles = 0
+        self.current = None
+        self.latencies = {name: deque(maxlen=history) for name, _, _ in SEGMENTS}
+
+    def start(self, requested=None, received=None):
+        if requested is None:
+            requested = time.monotonic()
+        self.current = SampleTrace(self.next_id, requested, received)
+        self.next_id += 1
+        return self.current
+
+    def finish(self, trace, idle=False):
+        """ Records the latencies of a trace, segments with missing stamps are left out.
+
+        Idle cycles only poll the encoder, they are counted but left out of the latencies.
+        """
+        self.cycles += 1
+        trace.finished = True
+        trace.idle = idle
+        if not idle:
+            self.record(trace)
+
+    def written(self, trace, written):
+        """ Stamps when the motor command of a trace was written to the serial port """
+        if trace.written is None:
+            trace.written = written
+            self.stamped(trace, 'written')
+
+    def sent(self, trace):
+        """ Stamps when the frame of a trace was first sent to a client """
+        if trace.broadcast is None:
+            trace.broadcast = time.monotonic()
+            self.stamped(trace, 'broadcast')
+
+    def stamped(self, trace, stamp):
+        """ Records the segments ending at a stamp taken after the trace finished, finish() records the others """
+        if trace.finished and not trace.idle:
+            self.record(trace, stamp)
+
+    def record(self, trace, stamp=None):
+        """ Records the segments ending at stamp, or every segment """
+        for name, begin, end in SEGMENTS:
+            if stamp is not None and end != stamp:
+                continue
+            begin, end = getattr(trace, begin), getattr(trace, end)
+            if begin is not None and end is not None and end >= begin:
+                self.latencies[name].append(end - begin)
+
+    def to_dict(self):
+        segments = {}
+        for name, values in self.latencies.items():
+            if not values:
+                continue
+            ordered = sorted(values)
+            segment = {'p{}'.format(p): percentile(ordered, p) for p in PERCENTILES}
+            segment.update({
+                'samples': len(ordered),
+                'mean': sum(ordered) / len(ordered),
+                'max': ordered[-1],
+            })
+            segments[name] = segment
+
+        return {
+            'device': self.device_id,
+            'traces': self.next_id - 1,
+            'cycles': self.cycles,
+            'segments': segments,
+        }
+
+
+def get(device_id=None):
+    if device_id is None:
+        return list(__tracers.values())
+
+    tracer = __tracers.get(device_id)
+    if tracer is None:
+        tracer = __tracers[device_id] = Tracer(device_id)
+    return tracer
@@ -21,6 +21,7 @@ setup(
         'munch',
         'ipaddress',
         'astropy',
+        'numpy',
         'pyserial',
         'flask',
         'flask-environments',
@@ -39,7 +40,10 @@ setup(
     author_email='github@tangopardo.com.ar',
     entry_points={
         'console_scripts': [
-            'ethernet-servo=ethernet_servo:main'
+            'ethernet-servo=ethernet_servo:main',
+            'ethernet-servo-loadtest=ethernet_servo.loadtest:main',
+            'ethernet-servo-benchmark=ethernet_servo.benchmark:main',
+            'ethernet-servo-gateway=ethernet_servo.gateway:main',
         ]
     },
     classifiers=[